@@ -0,0 +1,136 @@
+''' Benchmark of the Brackets class ranking on synthetic events
+
+Usage: python benchmarks/bench_brackets.py [--format fai64de] [--latency 2] [--repeat 20]
+
+For each supported format, a qualifier class and a fully raced bracket class are generated
+and brackets() is measured in three scenarios:
+  cold    all plugin state and saved standings dropped before each call (database change)
+  restart plugin state dropped before each call, saved standings still valid (server restart)
+  save    one race of a mid-bracket heat saved again before each call
+  cached  nothing changed since the previous call
+'''
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'custom_plugins'))
+
+import fake_rhapi
+fake_rhapi.install_stubs()
+
+import class_rank_brackets
+from eventmanager import Evt
+
+# saved standings are written at once, so that no background write falls in a measurement
+class_rank_brackets.SNAPSHOTS_SAVE_DELAY = 0
+
+
+
+def rank(rhapi, args):
+    return class_rank_brackets.brackets(rhapi, rhapi.db.classes[fake_rhapi.BRACKET_CLASS_ID], args)
+
+def prepare_cold(rhapi):
+    class_rank_brackets.invalidate_all()
+    class_rank_brackets.snapshots.clear()
+
+def prepare_restart(rhapi):
+    class_rank_brackets.invalidate_all()
+
+def prepare_save(rhapi):
+    # save again Round 1 of the heat in the middle of the raced ones
+    heats = sorted(set(race.heat_id for race in rhapi.db.races.values()))
+    heat_id = heats[len(heats)//2]
+    race = next(race for race in rhapi.db.races.values() if race.heat_id == heat_id)
+    rhapi.events.trigger(Evt.LAPS_RESAVE, {'race_id': race.id})
+
+def prepare_cached(rhapi):
+    pass
+
+SCENARIOS = [
+    ('cold', prepare_cold),
+    ('restart', prepare_restart),
+    ('save', prepare_save),
+    ('cached', prepare_cached),
+]
+
+
+
+def measure(rhapi, args, prepare, repeat):
+    # warm up, so that every scenario starts from a fully computed ranking
+    prepare_cold(rhapi)
+    rank(rhapi, args)
+
+    # wall time, DB calls made by the preparation step are not counted
+    elapsed = 0
+    calls = {}
+    for _ in range(repeat):
+        prepare(rhapi)
+        rhapi.db.calls.clear()
+        start = time.perf_counter()
+        rank(rhapi, args)
+        elapsed += time.perf_counter() - start
+        for name, count in rhapi.db.calls.items():
+            calls[name] = calls.get(name, 0) + count
+
+    # allocations are traced in a separate run, tracing slows down the computation
+    prepare(rhapi)
+    tracemalloc.start()
+    rank(rhapi, args)
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+
+    return {
+        'ms': elapsed*1000/repeat,
+        'calls': {name: count/repeat for name, count in calls.items()},
+        'peak_kib': peak/1024,
+        'blocks': blocks
+    }
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the Brackets class ranking")
+    parser.add_argument('--format', help="only formats with this name (e.g. fai64de)")
+    parser.add_argument('--bracket-type', help="only this bracket type (e.g. FAI)")
+    parser.add_argument('--latency', type=float, default=0, help="artificial latency of each DB call, in milliseconds")
+    parser.add_argument('--repeat', type=int, default=20, help="calls per scenario")
+    parser.add_argument('--pilots', type=int, help="pilots in the qualifier class (default: twice the bracket size)")
+    parser.add_argument('--raced-heats', type=int, help="only the first heats have been raced (default: all of them)")
+    parser.add_argument('--no-cta', action='store_true', help="disable Chase the Ace and Iron Man rule")
+    options = parser.parse_args()
+
+    print(f"{'type':<18} {'format':<10} {'heats':>5} {'scenario':<8} {'ms/call':>9} {'db/call':>8} {'peak KiB':>9} {'blocks':>7}  db calls")
+    for (bracket_type, number_of_heats), bracket_format in class_rank_brackets.BRACKET_FORMATS.items():
+        if options.format and bracket_format.name != options.format:
+            continue
+        if options.bracket_type and bracket_type != options.bracket_type:
+            continue
+
+        bracket_size = len(bracket_format.positions)+bracket_format.final_size
+        rhapi = fake_rhapi.build_event(number_of_heats, options.pilots or 2*bracket_size, latency=options.latency/1000,
+                                       raced_heats=options.raced_heats, final_size=bracket_format.final_size)
+        # rankings are measured on demand, not in the background
+        rhapi.db.options['brackets_recompute_window'] = '0'
+        class_rank_brackets.initialize(rhapi)
+        args = {
+            'bracket_type': bracket_type,
+            'qualifier_class': fake_rhapi.QUALIFIER_CLASS_ID,
+            'chase_the_ace': not options.no_cta,
+            'iron_man': not options.no_cta
+        }
+
+        class_rank_brackets.invalidate_all()
+        for scenario, prepare in SCENARIOS:
+            result = measure(rhapi, args, prepare, options.repeat)
+            calls = ", ".join(f"{name}={count:g}" for name, count in sorted(result['calls'].items()))
+            print(f"{bracket_type:<18} {bracket_format.name:<10} {number_of_heats:>5} {scenario:<8} {result['ms']:>9.3f} "
+                  f"{sum(result['calls'].values()):>8g} {result['peak_kib']:>9.1f} {result['blocks']:>7}  {calls}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+''' Check of the incremental ranking of the Brackets class ranking on synthetic events
+
+Usage: python benchmarks/check_incremental.py [--format fai64de] [--seeds 5] [--steps 40]
+
+For each supported format, a qualifier class and a bracket class are generated, then results are
+changed one step at a time and after each step the ranking kept up to date by the plugin is compared
+with a ranking computed from scratch. Steps are chosen at random among:
+  resave  a race is saved again with a different finish order, the TQ pilot flying every heat
+          and winning most of them (Iron Man rule verification rolled back and resumed)
+  add     a new round of the final is saved (Chase the Ace tally extended)
+  delete  a round of the final is deleted (Chase the Ace tally rolled back)
+Saved races of the final are also replaced by new result objects, so that rounds are rolled back
+by the identity of their results and not only by race ID.
+'''
+
+import argparse
+import copy
+import os
+import random
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'custom_plugins'))
+
+import fake_rhapi
+fake_rhapi.install_stubs()
+
+import class_rank_brackets
+from eventmanager import Evt
+
+# saved standings are written at once, not by a background timer
+class_rank_brackets.SNAPSHOTS_SAVE_DELAY = 0
+
+
+
+def rank(rhapi, args):
+    return class_rank_brackets.brackets(rhapi, rhapi.db.classes[fake_rhapi.BRACKET_CLASS_ID], args)
+
+def rank_from_scratch(rhapi, args):
+    # the plugin state is set aside, so that the incremental computation goes on afterwards
+    bracket_states = dict(class_rank_brackets.bracket_states)
+    qualifier_cache = dict(class_rank_brackets.qualifier_cache)
+    with class_rank_brackets.snapshots.lock:
+        snapshots = dict(class_rank_brackets.snapshots.snapshots())
+    class_rank_brackets.invalidate_all()
+    class_rank_brackets.snapshots.clear()
+    # alerts of the fresh computation are not mixed with the ones of the event
+    fresh_rhapi = copy.copy(rhapi)
+    fresh_rhapi.ui = fake_rhapi.FakeUI()
+    try:
+        ranking = rank(fresh_rhapi, args)
+        status = iron_man_status(rhapi)
+    finally:
+        class_rank_brackets.bracket_states.clear()
+        class_rank_brackets.bracket_states.update(bracket_states)
+        class_rank_brackets.qualifier_cache.clear()
+        class_rank_brackets.qualifier_cache.update(qualifier_cache)
+        with class_rank_brackets.snapshots.lock:
+            class_rank_brackets.snapshots.snapshots().update(snapshots)
+            class_rank_brackets.snapshots.save()
+        class_rank_brackets.snapshots.flush()
+    return ranking, status
+
+def iron_man_status(rhapi):
+    # the first heat lost by the TQ pilot and whether the final was won by Iron Man rule,
+    # the verification resumes from the heats already verified, or starts over with a fresh state
+    state = class_rank_brackets.bracket_states.get(fake_rhapi.BRACKET_CLASS_ID)
+    if not state:
+        return None
+    state.is_iron_man_available(tq_pilot_id(rhapi))
+    # the tally is brought up to date only while the final has rounds
+    is_iron_man = bool(final_races(rhapi) and state.chase_the_ace and state.chase_the_ace.is_iron_man)
+    return state.iron_man_lost_heat, is_iron_man
+
+
+
+def tq_pilot_id(rhapi):
+    qualifier = rhapi.db.class_results[fake_rhapi.QUALIFIER_CLASS_ID]['by_race_time']
+    return qualifier[0]['pilot_id']
+
+# the TQ pilot flies every heat and wins most of them, so that the Iron Man rule is both gained and lost
+TQ_WIN_RATE = 0.9
+
+def finish_order(rng, rhapi, heat_id):
+    pilot_ids = [slot.pilot_id for slot in rhapi.db.heat_slots[heat_id] if slot.pilot_id]
+    rng.shuffle(pilot_ids)
+    tq = tq_pilot_id(rhapi)
+    if tq in pilot_ids and rng.random() < TQ_WIN_RATE:
+        pilot_ids.remove(tq)
+        pilot_ids.insert(0, tq)
+    return pilot_ids
+
+def seed_tq_pilot(rng, rhapi):
+    # the TQ pilot takes the first slot of the heats it isn't seeded in, and results are raced again
+    tq = tq_pilot_id(rhapi)
+    for slots in rhapi.db.heat_slots.values():
+        if tq not in [slot.pilot_id for slot in slots]:
+            slots[0].pilot_id = tq
+    for race in rhapi.db.races.values():
+        rhapi.db.results[race.id] = fake_rhapi.build_leaderboard(rhapi.db, finish_order(rng, rhapi, race.heat_id))
+
+def final_races(rhapi):
+    final_heat_id = max(rhapi.db.heat_slots)
+    return sorted([race for race in rhapi.db.races.values() if race.heat_id == final_heat_id], key=lambda race: race.round_id)
+
+def step_resave(rng, rhapi):
+    races = final_races(rhapi)
+    race = rng.choice(races if races and rng.random() < 0.5 else list(rhapi.db.races.values()))
+    rhapi.db.results[race.id] = fake_rhapi.build_leaderboard(rhapi.db, finish_order(rng, rhapi, race.heat_id))
+    rhapi.events.trigger(Evt.LAPS_RESAVE, {'race_id': race.id})
+    return f"resave race {race.id}"
+
+def step_add(rng, rhapi):
+    races = final_races(rhapi)
+    heat_id = max(rhapi.db.heat_slots)
+    race_id = max(rhapi.db.races, default=0)+1
+    round_id = races[-1].round_id+1 if races else 1
+    rhapi.db.races[race_id] = types.SimpleNamespace(id=race_id, heat_id=heat_id, class_id=fake_rhapi.BRACKET_CLASS_ID, round_id=round_id)
+    rhapi.db.results[race_id] = fake_rhapi.build_leaderboard(rhapi.db, finish_order(rng, rhapi, heat_id))
+    rhapi.events.trigger(Evt.LAPS_SAVE, {'race_id': race_id})
+    return f"add race {race_id}"
+
+def step_delete(rng, rhapi):
+    races = final_races(rhapi)
+    if not races:
+        return step_add(rng, rhapi)
+    race = rng.choice(races)
+    del rhapi.db.races[race.id]
+    del rhapi.db.results[race.id]
+    # RotorHazard reports deleted races with a data reset that drops the whole state, invalidating only
+    # the heat keeps the state of the other heats, so that the tally has to be rolled back
+    class_rank_brackets.invalidate_class(fake_rhapi.BRACKET_CLASS_ID, race.heat_id)
+    class_rank_brackets.snapshots.discard(fake_rhapi.BRACKET_CLASS_ID)
+    return f"delete race {race.id}"
+
+STEPS = [step_resave, step_resave, step_add, step_delete]
+
+
+
+def check(bracket_type, bracket_format, args, seed, steps, final_size):
+    # number of mismatches between the incremental and the fresh ranking, the first one is reported
+    rng = random.Random(seed)
+    number_of_heats = bracket_format.number_of_heats
+    bracket_size = len(bracket_format.positions)+final_size
+    rhapi = fake_rhapi.build_event(number_of_heats, 2*bracket_size, seed=seed, final_rounds=rng.randint(0, 3),
+                                   final_size=final_size)
+    seed_tq_pilot(rng, rhapi)
+    rhapi.db.options['brackets_recompute_window'] = '0'
+    class_rank_brackets.initialize(rhapi)
+    class_rank_brackets.invalidate_all()
+    class_rank_brackets.snapshots.clear()
+    rank(rhapi, args)
+
+    mismatches = 0
+    history = []
+    for _ in range(steps):
+        history.append(rng.choice(STEPS)(rng, rhapi))
+        ranking = rank(rhapi, args)
+        status = iron_man_status(rhapi)
+        expected_ranking, expected_status = rank_from_scratch(rhapi, args)
+        if ranking != expected_ranking or status != expected_status:
+            if not mismatches:
+                print(f"  mismatch with seed {seed} after {', '.join(history)}")
+                print(f"    incremental {status} {ranking[0]}")
+                print(f"    fresh       {expected_status} {expected_ranking[0]}")
+            mismatches += 1
+    return mismatches
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check of the incremental Brackets class ranking")
+    parser.add_argument('--format', help="only formats with this name (e.g. fai64de)")
+    parser.add_argument('--bracket-type', help="only this bracket type (e.g. FAI)")
+    parser.add_argument('--seeds', type=int, default=5, help="events generated for each format and setting")
+    parser.add_argument('--steps', type=int, default=40, help="result changes applied to each event")
+    parser.add_argument('--final-size', type=int, help="pilots in the final (default: as in the format)")
+    options = parser.parse_args()
+
+    total = 0
+    failed = 0
+    for (bracket_type, number_of_heats), bracket_format in class_rank_brackets.BRACKET_FORMATS.items():
+        if options.format and bracket_format.name != options.format:
+            continue
+        if options.bracket_type and bracket_type != options.bracket_type:
+            continue
+
+        for chase_the_ace, iron_man in [(True, True), (True, False), (False, False)]:
+            args = {
+                'bracket_type': bracket_type,
+                'qualifier_class': fake_rhapi.QUALIFIER_CLASS_ID,
+                'chase_the_ace': chase_the_ace,
+                'iron_man': iron_man
+            }
+            mismatches = 0
+            for seed in range(options.seeds):
+                mismatches += check(bracket_type, bracket_format, args, seed, options.steps, options.final_size or bracket_format.final_size)
+            total += options.seeds*options.steps
+            failed += mismatches
+            print(f"{bracket_type:<18} {bracket_format.name:<10} {number_of_heats:>5} cta={chase_the_ace!s:<5} iron_man={iron_man!s:<5} "
+                  f"{mismatches} mismatches")
+
+    print(f"{failed} mismatches in {total} steps")
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+''' In-memory stand-in for the parts of RotorHazard used by the Brackets plugin '''
+
+import copy
+import enum
+import random
+import sys
+import time
+import types
+from collections import Counter
+
+
+
+class ProgramMethod(enum.IntEnum):
+    NONE = -1
+    ASSIGN = 0
+    HEAT_RESULT = 1
+    CLASS_RESULT = 2
+
+def install_stubs():
+    # modules imported by the plugin, only the names it uses are provided
+    if 'RHUtils' in sys.modules:
+        return
+
+    RHUtils = types.ModuleType('RHUtils')
+    RHUtils.PILOT_ID_NONE = 0
+    sys.modules['RHUtils'] = RHUtils
+
+    Database = types.ModuleType('Database')
+    Database.ProgramMethod = ProgramMethod
+    sys.modules['Database'] = Database
+
+    eventmanager = types.ModuleType('eventmanager')
+    class Evt:
+        pass
+    for name in ['CLASS_RANK_INITIALIZE', 'CLASS_ADD', 'CLASS_DUPLICATE', 'CLASS_ALTER', 'CLASS_DELETE',
+                 'LAPS_SAVE', 'LAPS_RESAVE', 'RACE_ALTER', 'ROUNDS_RESET',
+                 'HEAT_ADD', 'HEAT_DUPLICATE', 'HEAT_GENERATE', 'HEAT_ALTER', 'HEAT_DELETE', 'PILOT_ALTER',
+                 'DATABASE_RESET', 'DATABASE_RESTORE', 'DATABASE_RECOVER', 'CACHE_CLEAR', 'STARTUP', 'SHUTDOWN']:
+        setattr(Evt, name, name)
+    eventmanager.Evt = Evt
+    sys.modules['eventmanager'] = eventmanager
+
+    RHRace = types.ModuleType('RHRace')
+    RHRace.StartBehavior = object
+    sys.modules['RHRace'] = RHRace
+
+    Results = types.ModuleType('Results')
+    class RaceClassRankMethod:
+        def __init__(self, label, rank_fn, default_args=None, settings=None):
+            self.label = label
+            self.rank_fn = rank_fn
+            self.default_args = default_args
+            self.settings = settings
+    Results.RaceClassRankMethod = RaceClassRankMethod
+    sys.modules['Results'] = Results
+
+    RHUI = types.ModuleType('RHUI')
+    class UIField:
+        def __init__(self, name, label, field_type, value=None, desc=None, options=None, **kwargs):
+            self.name = name
+            self.label = label
+            self.field_type = field_type
+            self.value = value
+            self.desc = desc
+            self.options = options
+    class UIFieldType:
+        TEXT = 'text'
+        BASIC_INT = 'basic_int'
+        SELECT = 'select'
+        CHECKBOX = 'checkbox'
+    class UIFieldSelectOption:
+        def __init__(self, value, label):
+            self.value = value
+            self.label = label
+    RHUI.UIField = UIField
+    RHUI.UIFieldType = UIFieldType
+    RHUI.UIFieldSelectOption = UIFieldSelectOption
+    sys.modules['RHUI'] = RHUI
+
+
+
+class FakeDB:
+    """ rhapi.db backed by dicts, counting calls and optionally sleeping on each of them """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.classes = {}
+        self.class_results = {}
+        self.heats = {}
+        self.heat_slots = {}
+        self.races = {}
+        self.results = {}
+        self._pilots = {}
+        self.options = {}
+
+    def _query(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @property
+    def raceclasses(self):
+        self._query('raceclasses')
+        return list(self.classes.values())
+
+    def raceclass_by_id(self, raceclass_id):
+        self._query('raceclass_by_id')
+        return self.classes.get(raceclass_id)
+
+    def raceclass_results(self, raceclass):
+        self._query('raceclass_results')
+        return copy.deepcopy(self.class_results.get(raceclass.id))
+
+    def heats_by_class(self, raceclass_id):
+        self._query('heats_by_class')
+        return [heat for heat in self.heats.values() if heat.class_id == raceclass_id]
+
+    @property
+    def slots(self):
+        self._query('slots')
+        return [slot for slots in self.heat_slots.values() for slot in slots]
+
+    def slots_by_heat(self, heat_id):
+        self._query('slots_by_heat')
+        return list(self.heat_slots.get(heat_id, []))
+
+    def races_by_heat(self, heat_id):
+        self._query('races_by_heat')
+        return sorted([race for race in self.races.values() if race.heat_id == heat_id], key=lambda race: race.round_id)
+
+    def races_by_raceclass(self, raceclass_id):
+        self._query('races_by_raceclass')
+        return sorted([race for race in self.races.values() if race.class_id == raceclass_id], key=lambda race: (race.heat_id, race.round_id))
+
+    def race_by_id(self, race_id):
+        self._query('race_by_id')
+        return self.races.get(race_id)
+
+    def race_results(self, race):
+        self._query('race_results')
+        return copy.deepcopy(self.results.get(race.id))
+
+    @property
+    def pilots(self):
+        self._query('pilots')
+        return list(self._pilots.values())
+
+    def pilot_by_id(self, pilot_id):
+        self._query('pilot_by_id')
+        return self._pilots.get(pilot_id)
+
+    def option(self, name, default=None):
+        self._query('option')
+        return self.options.get(name, default)
+
+    def option_set(self, name, value):
+        self._query('option_set')
+        self.options[name] = value
+
+
+
+class FakeUI:
+    def __init__(self):
+        self.alerts = []
+        self.notifications = []
+        self.broadcasts = []
+
+    def message_alert(self, message):
+        self.alerts.append(message)
+
+    def message_notify(self, message):
+        self.notifications.append(message)
+
+    def socket_broadcast(self, message, data):
+        self.broadcasts.append((message, data))
+
+    def broadcast_raceclasses(self):
+        pass
+
+    def register_panel(self, *args, **kwargs):
+        pass
+
+    def register_quickbutton(self, *args, **kwargs):
+        pass
+
+
+
+class FakeEvents:
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, event, handler_fn, default_args=None, priority=None, unique=False, name=None):
+        self.handlers.setdefault(event, []).append(handler_fn)
+
+    def trigger(self, event, args=None):
+        for handler_fn in self.handlers.get(event, []):
+            handler_fn(args or {})
+
+
+
+class FakeFields:
+    def __init__(self):
+        self.options = []
+
+    def register_option(self, field, panel=None):
+        self.options.append(field)
+
+
+
+class FakeRHAPI:
+    def __init__(self, latency=0):
+        self.db = FakeDB(latency)
+        self.ui = FakeUI()
+        self.events = FakeEvents()
+        self.fields = FakeFields()
+        setattr(self, '__', lambda text: text)
+
+
+
+QUALIFIER_CLASS_ID = 1
+BRACKET_CLASS_ID = 2
+
+def build_leaderboard(db, pilot_ids):
+    return {
+        'meta': {'primary_leaderboard': 'by_race_time'},
+        'by_race_time': [{
+            'pilot_id': pilot_id,
+            'callsign': db._pilots[pilot_id].callsign,
+            'team_name': "",
+            'position': position
+        } for position, pilot_id in enumerate(pilot_ids, start=1)]
+    }
+
+def build_event(number_of_heats, number_of_pilots, seed=0, latency=0, raced_heats=None, final_rounds=None, final_size=4, nodes=8):
+    """ Qualifier class and bracket class with number_of_heats heats of 4 pilots each, final_size in the final
+
+    Heats have a slot for each of the nodes, seats left empty have no pilot. Heats after raced_heats
+    have no saved races yet and are seeded from the results of the previous heats, still unknown.
+    The final gets final_rounds rounds, or as many as needed for a pilot to win two of them.
+    """
+    rng = random.Random(seed)
+    rhapi = FakeRHAPI(latency)
+    db = rhapi.db
+
+    for pilot_id in range(1, number_of_pilots+1):
+        db._pilots[pilot_id] = types.SimpleNamespace(id=pilot_id, callsign=f"Pilot {pilot_id}", display_callsign=f"Pilot {pilot_id}", team="")
+
+    db.classes[QUALIFIER_CLASS_ID] = types.SimpleNamespace(id=QUALIFIER_CLASS_ID, name="Qualifier")
+    db.classes[BRACKET_CLASS_ID] = types.SimpleNamespace(id=BRACKET_CLASS_ID, name="Brackets")
+    qualifier = list(db._pilots)
+    rng.shuffle(qualifier)
+    db.class_results[QUALIFIER_CLASS_ID] = build_leaderboard(db, qualifier)
+
+    if raced_heats is None:
+        raced_heats = number_of_heats
+
+    race_id = 0
+    for heat_number in range(1, number_of_heats+1):
+        heat_id = 100+heat_number
+        db.heats[heat_id] = types.SimpleNamespace(id=heat_id, class_id=BRACKET_CLASS_ID, name=f"Heat {heat_number}")
+        pilot_ids = rng.sample(qualifier, final_size if heat_number == number_of_heats else 4)
+        if heat_number > raced_heats:
+            seats = [(0, ProgramMethod.HEAT_RESULT)] * len(pilot_ids)
+        else:
+            seats = [(pilot_id, ProgramMethod.ASSIGN) for pilot_id in pilot_ids]
+        seats += [(0, ProgramMethod.ASSIGN)] * (max(nodes, len(pilot_ids))-len(pilot_ids))
+        db.heat_slots[heat_id] = [types.SimpleNamespace(heat_id=heat_id, node_index=node_index, pilot_id=pilot_id, method=method)
+                                  for node_index, (pilot_id, method) in enumerate(seats)]
+        if heat_number > raced_heats or (heat_number == number_of_heats and final_rounds == 0):
+            continue
+
+        wins = Counter()
+        round_id = 0
+        while True:
+            round_id += 1
+            race_id += 1
+            finish_order = rng.sample(pilot_ids, len(pilot_ids))
+            db.races[race_id] = types.SimpleNamespace(id=race_id, heat_id=heat_id, class_id=BRACKET_CLASS_ID, round_id=round_id)
+            db.results[race_id] = build_leaderboard(db, finish_order)
+            wins[finish_order[0]] += 1
+            if heat_number < number_of_heats:
+                break
+            if final_rounds is not None:
+                if round_id >= final_rounds:
+                    break
+            elif max(wins.values()) > 1:
+                break
+
+    return rhapi
@@ -1,7 +1,13 @@
 ''' Class ranking method: Brackets '''
 
+import hashlib
+import json
 import logging
+import threading
+import time
+from collections import Counter, deque, namedtuple
 import RHUtils
+from Database import ProgramMethod
 from eventmanager import Evt
 from RHRace import StartBehavior
 from Results import RaceClassRankMethod
@@ -21,10 +27,170 @@ logger = logging.getLogger(__name__)
 MULTIGP = "MultiGP"
 FAI = "FAI"
 CSI = "CSI Drone Racing"
+FINAL_POSITIONS = 4  # pilots in the final of the formats, the final of a class may seat a different number
+HEAT_SLOTS = 4  # pilots expected in each heat of a bracket
+MISSING_PILOT_RANK = float("inf")  # qualifier rank of empty slots and of pilots not found in the qualifier class
 
 
 
-def apply_tiebreaker(leaderboard, qualifier, first_position, second_position):
+# Bracket formats
+# Each format lists where the pilots ranked after the final come from, as (heat number, position in heat),
+# top positions, one for each pilot of the final (4 in all formats), are handled separately due to CTA logic.
+# Tiebreakers are groups of positions, as (first position, last position), to be fixed using the qualifier results.
+BracketFormat = namedtuple('BracketFormat', ['name', 'description', 'number_of_heats', 'final_size', 'positions', 'tiebreakers'])
+
+def third_and_fourth(*heat_numbers):
+    return [(heat_number, heat_position) for heat_number in heat_numbers for heat_position in (3, 4)]
+
+def small_final(heat_number):
+    return [(heat_number, heat_position) for heat_position in (1, 2, 3, 4)]
+
+BRACKET_FORMAT_DEFINITIONS = [
+    {
+        'bracket_types': [MULTIGP, CSI],
+        'name': "ddr8de",
+        'description': "DDR 8 pilots double elimination (MultiGP style)",
+        'number_of_heats': 6,
+        'positions': third_and_fourth(5, 3),
+        'tiebreakers': []
+    },
+    {
+        'bracket_types': [MULTIGP, CSI],
+        'name': "multigp16",
+        'description': "MultiGP 16 pilots double elimination",
+        'number_of_heats': 14,
+        'positions': third_and_fourth(13, 12) + [(9, 3), (10, 3), (9, 4), (10, 4), (5, 3), (7, 3), (5, 4), (7, 4)],
+        'tiebreakers': [(9, 10), (11, 12), (13, 14), (15, 16)]
+    },
+    {
+        'bracket_types': [FAI],
+        'name': "ddr8de",
+        'description': "DDR 8 pilots double elimination (FAI style)",
+        'number_of_heats': 6,
+        'positions': third_and_fourth(5, 3),
+        'tiebreakers': [(5, 6), (7, 8)]
+    }
+]
+
+def fai_bracket_definition(number_of_pilots, double_elimination):
+    # FAI brackets are made of heats of 4 pilots where the first two advance,
+    # heats of each round of the winners bracket, semifinals included (e.g. [16, 8, 4, 2] for 64 pilots)
+    winners_rounds = []
+    heats = number_of_pilots // 4
+    while heats >= 2:
+        winners_rounds.append(heats)
+        heats //= 2
+
+    # assign heat numbers following the running order of the rounds
+    heat_numbers = {}
+    def schedule(round_name, number_of_heats):
+        first_heat = sum(len(x) for x in heat_numbers.values()) + 1
+        heat_numbers[round_name] = list(range(first_heat, first_heat+number_of_heats))
+
+    positions = []
+    tiebreakers = []
+    if not double_elimination:
+        # winners rounds, then small final and final
+        for round_number, number_of_heats in enumerate(winners_rounds, start=1):
+            schedule(f"W{round_number}", number_of_heats)
+        schedule("small_final", 1)
+        schedule("final", 1)
+        small_final_heat = heat_numbers["small_final"][0]
+
+        # positions 5-8 from the small final, then 3rd and 4th place of each round before semifinals, latest round first
+        positions += small_final(small_final_heat)
+        eliminated_rounds = [heat_numbers[f"W{round_number}"] for round_number in range(len(winners_rounds)-1, 0, -1)]
+    else:
+        # losers round 1 is made of 3rd and 4th place of winners round 1,
+        # then each winners round r is followed by losers round 2r-2 (its 3rd and 4th place joining the losers bracket) and 2r-1
+        # losers round 1 is run before winners round 2 only if this is already the semifinal
+        schedule("W1", winners_rounds[0])
+        if len(winners_rounds) > 2:
+            schedule("W2", winners_rounds[1])
+            schedule("L1", winners_rounds[0] // 2)
+        else:
+            schedule("L1", winners_rounds[0] // 2)
+            schedule("W2", winners_rounds[1])
+        schedule("L2", winners_rounds[1])
+        schedule("L3", winners_rounds[1] // 2)
+        for round_number in range(3, len(winners_rounds)+1):
+            schedule(f"W{round_number}", winners_rounds[round_number-1])
+            schedule(f"L{2*round_number-2}", winners_rounds[round_number-1])
+            schedule(f"L{2*round_number-1}", winners_rounds[round_number-1] // 2)
+        schedule("winners_final", 1)
+        schedule("losers_final", 1)
+        schedule("final", 1)
+
+        # positions 5-8 from losers final and last losers round, then 3rd and 4th place of each losers round, latest round first
+        last_losers_round = 2*len(winners_rounds)-1
+        positions += third_and_fourth(heat_numbers["losers_final"][0], heat_numbers[f"L{last_losers_round}"][0])
+        small_final_heat = None
+        eliminated_rounds = [heat_numbers[f"L{round_number}"] for round_number in range(last_losers_round-1, 0, -1)]
+
+    for round_heats in eliminated_rounds:
+        first_position = len(positions) + 5
+        positions += third_and_fourth(*reversed(round_heats))
+        tiebreakers.append((first_position, len(positions) + 4))
+
+    definition = {
+        'bracket_types': [FAI],
+        'name': f"fai{number_of_pilots}{'de' if double_elimination else ''}",
+        'description': f"FAI {number_of_pilots} pilots {'double' if double_elimination else 'single'} elimination",
+        'number_of_heats': heat_numbers["final"][0],
+        'positions': positions,
+        'tiebreakers': tiebreakers
+    }
+    if small_final_heat:
+        definition['small_final'] = small_final_heat
+    return definition
+
+def compile_bracket_format(definition):
+    # positions below the final are numbered after the pilots of the final
+    final_size = definition.get('final_size', FINAL_POSITIONS)
+    positions = []
+    for position, (heat_number, heat_position) in enumerate(definition['positions'], start=final_size+1):
+        if heat_number == definition.get('small_final'):
+            label = f"{heat_position}° in Small Final"
+        else:
+            label = f"{heat_position}° in Heat {heat_number}"
+        positions.append((position, heat_number, heat_position, label))
+
+    return BracketFormat(definition['name'],
+                         definition['description'],
+                         definition['number_of_heats'],
+                         final_size,
+                         tuple(positions),
+                         tuple(definition['tiebreakers']))
+
+# FAI formats follow the same structure for any number of pilots, so they are generated
+FAI_BRACKET_SIZES = [16, 32, 64, 128, 256]
+for number_of_pilots in FAI_BRACKET_SIZES:
+    BRACKET_FORMAT_DEFINITIONS.append(fai_bracket_definition(number_of_pilots, False))
+    BRACKET_FORMAT_DEFINITIONS.append(fai_bracket_definition(number_of_pilots, True))
+
+# formats are compiled once and looked up by (bracket type, number of heats)
+BRACKET_FORMATS = {}
+for definition in BRACKET_FORMAT_DEFINITIONS:
+    for bracket_type in definition['bracket_types']:
+        BRACKET_FORMATS[(bracket_type, definition['number_of_heats'])] = compile_bracket_format(definition)
+
+def resize_final(bracket_format, final_size):
+    # top positions are as many as the pilots of the final, the following positions are numbered after them
+    offset = final_size - bracket_format.final_size
+    return bracket_format._replace(
+        final_size=final_size,
+        positions=tuple((position+offset, heat_number, heat_position, label) for position, heat_number, heat_position, label in bracket_format.positions),
+        tiebreakers=tuple((first_position+offset, second_position+offset) for first_position, second_position in bracket_format.tiebreakers))
+
+def get_bracket_format(bracket_type, number_of_heats, final_size=None):
+    bracket_format = BRACKET_FORMATS.get((bracket_type, number_of_heats))
+    if bracket_format and final_size and final_size != bracket_format.final_size:
+        bracket_format = resize_final(bracket_format, final_size)
+    return bracket_format
+
+
+
+def apply_tiebreaker(leaderboard, qualifier_rank, first_position, second_position):
     # assume that first_position < second_position and they are 1-based
     from_index = first_position-1
     to_index = second_position
@@ -33,7 +199,7 @@ def apply_tiebreaker(leaderboard, qualifier, first_position, second_position):
     leaderboard_slice = leaderboard[from_index:to_index]
 
     # order them by position in qualifier class
-    leaderboard_slice = sorted(leaderboard_slice, key=lambda x: qualifier.index(x['pilot_id']) if x else 1024) # corner case for missing pilots
+    leaderboard_slice = sorted(leaderboard_slice, key=lambda x: qualifier_rank.get(x.pilot_id, MISSING_PILOT_RANK) if x else MISSING_PILOT_RANK) # corner case for missing pilots
 
     for i in range(to_index-from_index):
         # update the order of pilots in the leaderboard
@@ -41,624 +207,921 @@ def apply_tiebreaker(leaderboard, qualifier, first_position, second_position):
         # and their position
         if leaderboard[from_index+i]:
             # corner case for missing pilots
-            leaderboard[from_index+i]['position'] = first_position+i
-
-
-
-def apply_tiebreaker_generic(leaderboard, qualifier, number_of_heats, bracket_type):
-    if bracket_type == MULTIGP or bracket_type == CSI:
-        # no tiebreaker for ddr8de
-        if number_of_heats == 14:
-            # multigp16
-            apply_tiebreaker(leaderboard, qualifier, 9, 10)    # Q1
-            apply_tiebreaker(leaderboard, qualifier, 11, 12)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 13, 14)   # Q3
-            apply_tiebreaker(leaderboard, qualifier, 15, 16)   # Q4
-    elif bracket_type == FAI:
-        if number_of_heats == 6:
-            # ddr8de
-            apply_tiebreaker(leaderboard, qualifier, 5, 6)     # Q1
-            apply_tiebreaker(leaderboard, qualifier, 7, 8)     # Q2
-        elif number_of_heats == 8:
-            # fai16
-            apply_tiebreaker(leaderboard, qualifier, 9,  16)   # Q1
-        elif number_of_heats == 14:
-            # fai16de
-            apply_tiebreaker(leaderboard, qualifier, 9,  12)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 13, 16)   # Q2
-        elif number_of_heats == 16:
-            # fai32
-            apply_tiebreaker(leaderboard, qualifier, 9,  16)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 17, 32)   # Q2
-        elif number_of_heats == 30:
-            # fai32de
-            apply_tiebreaker(leaderboard, qualifier, 9,  12)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 13, 16)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 17, 24)   # Q3
-            apply_tiebreaker(leaderboard, qualifier, 25, 32)   # Q4
-        elif number_of_heats == 32:
-            # fai64
-            apply_tiebreaker(leaderboard, qualifier, 9,  16)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 17, 32)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 33, 64)   # Q3
-        elif number_of_heats == 62:
-            # fai64de
-            apply_tiebreaker(leaderboard, qualifier, 9,  12)   # Q1
-            apply_tiebreaker(leaderboard, qualifier, 13, 16)   # Q2
-            apply_tiebreaker(leaderboard, qualifier, 17, 24)   # Q3
-            apply_tiebreaker(leaderboard, qualifier, 25, 32)   # Q4
-            apply_tiebreaker(leaderboard, qualifier, 33, 48)   # Q5
-            apply_tiebreaker(leaderboard, qualifier, 49, 64)   # Q6
+            leaderboard[from_index+i].position = first_position+i
+
+
+
+class LeaderboardEntry:
+    """ Ranked pilot, converted to the dict expected by RotorHazard only once the ranking is complete """
+    __slots__ = ('pilot_id', 'callsign', 'team_name', 'position', 'result')
+
+    def __init__(self, slot, position, result):
+        self.pilot_id = slot['pilot_id']
+        self.callsign = slot['callsign']
+        self.team_name = slot['team_name']
+        self.position = position
+        self.result = result
+
+    def as_dict(self):
+        return {
+            'pilot_id': self.pilot_id,
+            'callsign': self.callsign,
+            'team_name': self.team_name,
+            'position': self.position,
+            'result': self.result
+        }
 
 
 
 def build_leaderboard_object_basic(rhapi, position, slot, result):
-    return {
-        'pilot_id': slot['pilot_id'],
-        'callsign': slot['callsign'],
-        'team_name': slot['team_name'],
-        'position': position,
-        'result': result
-    }
+    return LeaderboardEntry(slot, position, result)
+
+
+
+class HeatResultsCache:
+    """ Round 1 results of each heat of the bracket class, loaded at most once until the heat changes """
+    def __init__(self, rhapi, class_id, heats):
+        self.rhapi = rhapi
+        self.class_id = class_id
+        self.heats = heats
+        self._heat_numbers = {heat.id: heat_number for heat_number, heat in enumerate(heats, start=1)}
+        self._races = None
+        self._leaderboards = {}
+
+    def heat_number(self, heat_id):
+        return self._heat_numbers.get(heat_id)
+
+    def invalidate_heat(self, heat_id, race_id=None):
+        if race_id:
+            # only this race has been saved again, the other rounds are still valid
+            self._leaderboards.pop(race_id, None)
+        elif self._races:
+            for race in self._races.get(self._heat_numbers.get(heat_id), []):
+                self._leaderboards.pop(race.id, None)
+        # races of the class are reloaded with a single query
+        self._races = None
+
+    def load_races(self):
+        # races of all heats with a single query, instead of one query per heat
+        self._races = {}
+        for race in self.rhapi.db.races_by_raceclass(self.class_id):
+            heat_number = self._heat_numbers.get(race.heat_id)
+            if heat_number:
+                self._races.setdefault(heat_number, []).append(race)
+        for races in self._races.values():
+            races.sort(key=lambda race: race.round_id)
 
+    def races(self, heat_number):
+        # heat_number is 1-based
+        if self._races is None:
+            self.load_races()
+        return self._races.get(heat_number, [])
 
+    def is_raced(self, heat_number):
+        # heat_number is 1-based, the heat has at least one saved race
+        return len(self.races(heat_number)) > 0
 
-def build_leaderboard_object(rhapi, position, heats, heat_number, heat_position, result):
-    if heat_number <= len(heats):
-        heat = heats[heat_number-1]
-        # for robustness, don't use heat_results but get results from Round 1 instead
-        races = rhapi.db.races_by_heat(heat.id)
-        if races:
-            race_result = rhapi.db.race_results(races[0])
+    def race_leaderboard(self, race):
+        # primary leaderboard of a single round, None if results are not available
+        if race.id not in self._leaderboards:
+            heat_leaderboard = None
+            race_result = self.rhapi.db.race_results(race)
             if race_result:
                 heat_leaderboard = race_result[race_result['meta']['primary_leaderboard']]
-                # corner case for heats with missing pilots
-                if heat_position <= len(heat_leaderboard):
-                    slot = heat_leaderboard[heat_position-1]
-
-                    return {
-                        'pilot_id': slot['pilot_id'],
-                        'callsign': slot['callsign'],
-                        'team_name': slot['team_name'],
-                        'position': position,
-                        'result': result
-                    }
+            self._leaderboards[race.id] = heat_leaderboard
+        return self._leaderboards[race.id]
+
+    def leaderboard(self, heat_number):
+        # heat_number is 1-based, None is returned if the heat does not exist or has not been raced yet
+        if heat_number <= len(self.heats):
+            # for robustness, don't use heat_results but get results from Round 1 instead
+            races = self.races(heat_number)
+            if races:
+                return self.race_leaderboard(races[0])
+        return None
+
+
+
+def build_leaderboard_object(heat_results, position, heat_number, heat_position, result):
+    heat_leaderboard = heat_results.leaderboard(heat_number)
+    # corner case for heats with missing pilots
+    if heat_leaderboard and heat_position <= len(heat_leaderboard):
+        return LeaderboardEntry(heat_leaderboard[heat_position-1], position, result)
 
     return None
 
 
 
-def build_leaderboard_generic(rhapi, heats, bracket_type):
-    logger.info(f"Found {len(heats)} heats in the bracket class")
-    if bracket_type == MULTIGP or bracket_type == CSI:
-        if len(heats) == 6:
-            # ddr8de
-            logger.info(f"Format detected: DDR 8 pilots double elimination (MultiGP style)")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 5, 3, "3° in Heat 5"),
-                build_leaderboard_object(rhapi, 6,  heats, 5, 4, "4° in Heat 5"),
-                build_leaderboard_object(rhapi, 7,  heats, 3, 3, "3° in Heat 3"),
-                build_leaderboard_object(rhapi, 8,  heats, 3, 4, "4° in Heat 3")
-            ]
-        elif len(heats) == 14:
-            # multigp16
-            logger.info(f"Format detected: MultiGP 16 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 13, 3, "3° in Heat 13"),
-                build_leaderboard_object(rhapi, 6,  heats, 13, 4, "4° in Heat 13"),
-                build_leaderboard_object(rhapi, 7,  heats, 12, 3, "3° in Heat 12"),
-                build_leaderboard_object(rhapi, 8,  heats, 12, 4, "4° in Heat 12"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 9,  3, "3° in Heat 9"),   # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 10, 3, "3° in Heat 10"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 11, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 12, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 14, heats, 7,  3, "3° in Heat 7"),   # to be fixed Q3
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 15, heats, 5,  4, "4° in Heat 5"),   # to be fixed Q4
-                build_leaderboard_object(rhapi, 16, heats, 7,  4, "4° in Heat 7")    # to be fixed Q4
-            ]
-        else:
-            # unsupported format
-            return None
-    elif bracket_type == FAI:
-        if len(heats) == 6:
-            # ddr8de
-            logger.info(f"Format detected: DDR 8 pilots double elimination (FAI style)")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 5,  heats, 5, 3, "3° in Heat 5"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 6,  heats, 5, 4, "4° in Heat 5"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 7,  heats, 3, 3, "3° in Heat 3"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 8,  heats, 3, 4, "4° in Heat 3")   # to be fixed Q2
-            ]
-        elif len(heats) == 8:
-            # fai16
-            logger.info(f"Format detected: FAI 16 pilots single elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 7, 1, "1° in Small Final"),
-                build_leaderboard_object(rhapi, 6,  heats, 7, 2, "2° in Small Final"),
-                build_leaderboard_object(rhapi, 7,  heats, 7, 3, "3° in Small Final"),
-                build_leaderboard_object(rhapi, 8,  heats, 7, 4, "4° in Small Final"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 4, 3, "3° in Heat 4"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 4, 4, "4° in Heat 4"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 3, 3, "3° in Heat 3"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 3, 4, "4° in Heat 3"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 13, heats, 2, 3, "3° in Heat 2"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 14, heats, 2, 4, "4° in Heat 2"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 15, heats, 1, 3, "3° in Heat 1"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 16, heats, 1, 4, "4° in Heat 1")   # to be fixed Q1
-            ]
-        elif len(heats) == 14:
-            # fai16de
-            logger.info(f"Format detected: FAI 16 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 13, 3, "3° in Heat 13"),
-                build_leaderboard_object(rhapi, 6,  heats, 13, 4, "4° in Heat 13"),
-                build_leaderboard_object(rhapi, 7,  heats, 11, 3, "3° in Heat 11"),
-                build_leaderboard_object(rhapi, 8,  heats, 11, 4, "4° in Heat 11"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 10, 3, "3° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 9,  3, "3° in Heat 9"),   # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 6,  3, "3° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 14, heats, 6,  4, "4° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 15, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 16, heats, 5,  4, "4° in Heat 5")    # to be fixed Q2
-            ]
-        elif len(heats) == 16:
-            # fai32
-            logger.info(f"Format detected: FAI 32 pilots single elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 15, 1, "1° in Small Final"),
-                build_leaderboard_object(rhapi, 6,  heats, 15, 2, "2° in Small Final"),
-                build_leaderboard_object(rhapi, 7,  heats, 15, 3, "3° in Small Final"),
-                build_leaderboard_object(rhapi, 8,  heats, 15, 4, "4° in Small Final"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 12, 3, "3° in Heat 12"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 12, 4, "4° in Heat 12"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 11, 3, "3° in Heat 11"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 11, 4, "4° in Heat 11"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 13, heats, 10, 3, "3° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 14, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 15, heats, 9,  3, "3° in Heat 9"),   # to be fixed Q1
-                build_leaderboard_object(rhapi, 16, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 8,  3, "3° in Heat 8"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 18, heats, 8,  4, "4° in Heat 8"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 19, heats, 7,  3, "3° in Heat 7"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 20, heats, 7,  4, "4° in Heat 7"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 21, heats, 6,  3, "3° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 22, heats, 6,  4, "4° in Heat 6"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 23, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 24, heats, 5,  4, "4° in Heat 5"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 25, heats, 4,  3, "3° in Heat 4"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 26, heats, 4,  4, "4° in Heat 4"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 27, heats, 3,  3, "3° in Heat 3"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 28, heats, 3,  4, "4° in Heat 3"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 29, heats, 2,  3, "3° in Heat 2"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 30, heats, 2,  4, "4° in Heat 2"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 31, heats, 1,  3, "3° in Heat 1"),   # to be fixed Q2
-                build_leaderboard_object(rhapi, 32, heats, 1,  4, "4° in Heat 1")    # to be fixed Q2
-            ]
-        elif len(heats) == 30:
-            # fai32de
-            logger.info(f"Format detected: FAI 32 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 29, 3, "3° in Heat 29"),
-                build_leaderboard_object(rhapi, 6,  heats, 29, 4, "4° in Heat 29"),
-                build_leaderboard_object(rhapi, 7,  heats, 27, 3, "3° in Heat 27"),
-                build_leaderboard_object(rhapi, 8,  heats, 27, 4, "4° in Heat 27"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 26, 3, "3° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 26, 4, "4° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 25, 3, "3° in Heat 25"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 25, 4, "4° in Heat 25"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 22, 3, "3° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 14, heats, 22, 4, "4° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 15, heats, 21, 3, "3° in Heat 21"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 16, heats, 21, 4, "4° in Heat 21"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 20, 3, "3° in Heat 20"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 18, heats, 20, 4, "4° in Heat 20"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 19, heats, 19, 3, "3° in Heat 19"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 20, heats, 19, 4, "4° in Heat 19"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 21, heats, 18, 3, "3° in Heat 18"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 22, heats, 18, 4, "4° in Heat 18"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 23, heats, 17, 3, "3° in Heat 17"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 24, heats, 17, 4, "4° in Heat 17"),  # to be fixed Q3
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 25, heats, 16, 3, "3° in Heat 16"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 26, heats, 16, 4, "4° in Heat 16"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 27, heats, 15, 3, "3° in Heat 15"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 28, heats, 15, 4, "4° in Heat 15"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 29, heats, 14, 3, "3° in Heat 14"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 30, heats, 14, 4, "4° in Heat 14"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 31, heats, 13, 3, "3° in Heat 13"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 32, heats, 13, 4, "4° in Heat 13")   # to be fixed Q4
-            ]
-        elif len(heats) == 32:
-            # fai64
-            logger.info(f"Format detected: FAI 64 pilots single elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 31, 1, "1° in Small Final"),
-                build_leaderboard_object(rhapi, 6,  heats, 31, 2, "2° in Small Final"),
-                build_leaderboard_object(rhapi, 7,  heats, 31, 3, "3° in Small Final"),
-                build_leaderboard_object(rhapi, 8,  heats, 31, 4, "4° in Small Final"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 28, 3, "3° in Heat 28"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 28, 4, "4° in Heat 28"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 27, 3, "3° in Heat 27"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 27, 4, "4° in Heat 27"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 13, heats, 26, 3, "3° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 14, heats, 26, 4, "4° in Heat 26"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 15, heats, 25, 3, "3° in Heat 25"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 16, heats, 25, 4, "4° in Heat 25"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 24, 3, "3° in Heat 24"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 18, heats, 24, 4, "4° in Heat 24"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 19, heats, 23, 3, "3° in Heat 23"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 20, heats, 23, 4, "4° in Heat 23"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 21, heats, 22, 3, "3° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 22, heats, 22, 4, "4° in Heat 22"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 23, heats, 21, 3, "3° in Heat 21"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 24, heats, 21, 4, "4° in Heat 21"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 25, heats, 20, 3, "3° in Heat 20"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 26, heats, 20, 4, "4° in Heat 20"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 27, heats, 19, 3, "3° in Heat 19"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 28, heats, 19, 4, "4° in Heat 19"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 29, heats, 18, 3, "3° in Heat 18"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 30, heats, 18, 4, "4° in Heat 18"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 31, heats, 17, 3, "3° in Heat 17"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 32, heats, 17, 4, "4° in Heat 17"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 33, heats, 16, 3, "3° in Heat 16"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 34, heats, 16, 4, "4° in Heat 16"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 35, heats, 15, 3, "3° in Heat 15"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 36, heats, 15, 4, "4° in Heat 15"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 37, heats, 14, 3, "3° in Heat 14"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 38, heats, 14, 4, "4° in Heat 14"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 39, heats, 13, 3, "3° in Heat 13"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 40, heats, 13, 4, "4° in Heat 13"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 41, heats, 12, 3, "3° in Heat 12"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 42, heats, 12, 4, "4° in Heat 12"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 43, heats, 11, 3, "3° in Heat 11"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 44, heats, 11, 4, "4° in Heat 11"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 45, heats, 10, 3, "3° in Heat 10"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 46, heats, 10, 4, "4° in Heat 10"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 47, heats, 9,  3, "3° in Heat 9"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 48, heats, 9,  4, "4° in Heat 9"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 49, heats, 8,  3, "3° in Heat 8"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 50, heats, 8,  4, "4° in Heat 8"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 51, heats, 7,  3, "3° in Heat 7"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 52, heats, 7,  4, "4° in Heat 7"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 53, heats, 6,  3, "3° in Heat 6"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 54, heats, 6,  4, "4° in Heat 6"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 55, heats, 5,  3, "3° in Heat 5"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 56, heats, 5,  4, "4° in Heat 5"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 57, heats, 4,  3, "3° in Heat 4"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 58, heats, 4,  4, "4° in Heat 4"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 59, heats, 3,  3, "3° in Heat 3"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 60, heats, 3,  4, "4° in Heat 3"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 61, heats, 2,  3, "3° in Heat 2"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 62, heats, 2,  4, "4° in Heat 2"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 63, heats, 1,  3, "3° in Heat 1"),   # to be fixed Q3
-                build_leaderboard_object(rhapi, 64, heats, 1,  4, "4° in Heat 1")    # to be fixed Q3
-            ]
-        elif len(heats) == 62:
-            # fai64de
-            logger.info(f"Format detected: FAI 64 pilots double elimination")
-            return [
-                None,  # top 4 positions are handled later due to CTA logic
-                None,
-                None,
-                None,
-                build_leaderboard_object(rhapi, 5,  heats, 61, 3, "3° in Heat 61"),
-                build_leaderboard_object(rhapi, 6,  heats, 61, 4, "4° in Heat 61"),
-                build_leaderboard_object(rhapi, 7,  heats, 59, 3, "3° in Heat 59"),
-                build_leaderboard_object(rhapi, 8,  heats, 59, 4, "4° in Heat 59"),
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 9,  heats, 58, 3, "3° in Heat 58"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 10, heats, 58, 4, "4° in Heat 58"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 11, heats, 57, 3, "3° in Heat 57"),  # to be fixed Q1
-                build_leaderboard_object(rhapi, 12, heats, 57, 4, "4° in Heat 57"),  # to be fixed Q1
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 13, heats, 54, 3, "3° in Heat 54"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 14, heats, 54, 4, "4° in Heat 54"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 15, heats, 53, 3, "3° in Heat 53"),  # to be fixed Q2
-                build_leaderboard_object(rhapi, 16, heats, 53, 4, "4° in Heat 53"),  # to be fixed Q2
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 17, heats, 52, 3, "3° in Heat 52"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 18, heats, 52, 4, "4° in Heat 52"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 19, heats, 51, 3, "3° in Heat 51"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 20, heats, 51, 4, "4° in Heat 51"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 21, heats, 50, 3, "3° in Heat 50"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 22, heats, 50, 4, "4° in Heat 50"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 23, heats, 49, 3, "3° in Heat 49"),  # to be fixed Q3
-                build_leaderboard_object(rhapi, 24, heats, 49, 4, "4° in Heat 49"),  # to be fixed Q3
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 25, heats, 44, 3, "3° in Heat 44"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 26, heats, 44, 4, "4° in Heat 44"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 27, heats, 43, 3, "3° in Heat 43"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 28, heats, 43, 4, "4° in Heat 43"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 29, heats, 42, 3, "3° in Heat 42"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 30, heats, 42, 4, "4° in Heat 42"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 31, heats, 41, 3, "3° in Heat 41"),  # to be fixed Q4
-                build_leaderboard_object(rhapi, 32, heats, 41, 4, "4° in Heat 41"),  # to be fixed Q4
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 33, heats, 40, 3, "3° in Heat 40"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 34, heats, 40, 4, "4° in Heat 40"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 35, heats, 39, 3, "3° in Heat 39"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 36, heats, 39, 4, "4° in Heat 39"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 37, heats, 38, 3, "3° in Heat 38"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 38, heats, 38, 4, "4° in Heat 38"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 39, heats, 37, 3, "3° in Heat 37"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 40, heats, 37, 4, "4° in Heat 37"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 41, heats, 36, 3, "3° in Heat 36"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 42, heats, 36, 4, "4° in Heat 36"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 43, heats, 35, 3, "3° in Heat 35"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 44, heats, 35, 4, "4° in Heat 35"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 45, heats, 34, 3, "3° in Heat 34"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 46, heats, 34, 4, "4° in Heat 34"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 47, heats, 33, 3, "3° in Heat 33"),  # to be fixed Q5
-                build_leaderboard_object(rhapi, 48, heats, 33, 4, "4° in Heat 33"),  # to be fixed Q5
-                ####################################################################################################
-                build_leaderboard_object(rhapi, 49, heats, 32, 3, "3° in Heat 32"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 50, heats, 32, 4, "4° in Heat 32"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 51, heats, 31, 3, "3° in Heat 31"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 52, heats, 31, 4, "4° in Heat 31"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 53, heats, 30, 3, "3° in Heat 30"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 54, heats, 30, 4, "4° in Heat 30"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 55, heats, 29, 3, "3° in Heat 29"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 56, heats, 29, 4, "4° in Heat 29"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 57, heats, 28, 3, "3° in Heat 28"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 58, heats, 28, 4, "4° in Heat 28"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 59, heats, 27, 3, "3° in Heat 27"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 60, heats, 27, 4, "4° in Heat 27"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 61, heats, 26, 3, "3° in Heat 26"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 62, heats, 26, 4, "4° in Heat 26"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 63, heats, 25, 3, "3° in Heat 25"),  # to be fixed Q6
-                build_leaderboard_object(rhapi, 64, heats, 25, 4, "4° in Heat 25")   # to be fixed Q6
-            ]
+class LazyLeaderboard:
+    """ Leaderboard of a bracket class, each position is read from the heat results only when first accessed
+
+    Top positions are handled by the caller due to CTA logic. Positions sharing a tiebreak are resolved together.
+    """
+    UNRESOLVED = object()
+
+    def __init__(self, heat_results, bracket_format, qualifier_rank):
+        self.heat_results = heat_results
+        self.bracket_format = bracket_format
+        self.qualifier_rank = qualifier_rank
+        self._entries = [None] * bracket_format.final_size + [self.UNRESOLVED] * len(bracket_format.positions)
+        self._tiebreakers = {}
+        for first_position, second_position in bracket_format.tiebreakers:
+            for position in range(first_position, second_position+1):
+                self._tiebreakers[position] = (first_position, second_position)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        if self._entries[index] is self.UNRESOLVED:
+            self.resolve(index+1)
+        return self._entries[index]
+
+    def __setitem__(self, index, entry):
+        self._entries[index] = entry
+
+    def resolve(self, position):
+        first_position, second_position = self._tiebreakers.get(position, (position, position))
+        for index in range(first_position-1, second_position):
+            _, heat_number, heat_position, label = self.bracket_format.positions[index-self.bracket_format.final_size]
+            self._entries[index] = build_leaderboard_object(self.heat_results, index+1, heat_number, heat_position, label)
+        # apply qualifier results to resolve ties, unless heats of this stage have not been raced yet
+        if first_position != second_position and any(self._entries[first_position-1:second_position]):
+            apply_tiebreaker(self._entries, self.qualifier_rank, first_position, second_position)
+
+    def materialize(self, count=None):
+        # the first count positions, or all of them
+        return [self[index] for index in range(min(count, len(self)) if count is not None else len(self))]
+
+
+
+class PilotCallsigns:
+    """ Display callsign of each pilot, loaded with a single query when first needed during a ranking computation """
+    def __init__(self, rhapi):
+        self.rhapi = rhapi
+        self._callsigns = None
+
+    def get(self, pilot_id, default=None):
+        if self._callsigns is None:
+            self._callsigns = {pilot.id: pilot.display_callsign for pilot in self.rhapi.db.pilots}
+        return self._callsigns.get(pilot_id, default)
+
+
+
+class ChaseTheAce:
+    """ Tally of the final heat, consuming one round at a time """
+    def __init__(self, pilot_ids, tq_pilot_id, is_iron_man_available):
+        self.tq_pilot_id = tq_pilot_id
+        self.is_iron_man_available = is_iron_man_available
+        # initialize data for each pilot in the final, places counts how many times the pilot finished in each position
+        self.size = len(pilot_ids)
+        self.winners = {}
+        for pilot_id in pilot_ids:
+            self.winners[pilot_id] = self.new_tally()
+        # (race ID, leaderboard, winner callsign) of each consumed round, leaderboard is None if the round has no results
+        self.rounds = []
+        self.is_iron_man = False
+        self.is_over = False
+
+    @property
+    def winners_names(self):
+        return [winner_callsign for _, _, winner_callsign in self.rounds if winner_callsign]
+
+    @property
+    def last_leaderboard(self):
+        return self.rounds[-1][1]
+
+    def consume(self, race_id, heat_leaderboard, pilot_callsigns):
+        if not heat_leaderboard:
+            self.rounds.append((race_id, heat_leaderboard, None))
+            return
+
+        winner_pilot_id = heat_leaderboard[0]['pilot_id']
+        if len(self.rounds) == 0 and self.is_iron_man_available and winner_pilot_id == self.tq_pilot_id:
+            # race is over (Iron Man)
+            self.rounds.append((race_id, heat_leaderboard, None))
+            self.is_iron_man = True
+            self.is_over = True
+            return
+
+        winner_callsign = pilot_callsigns.get(winner_pilot_id, heat_leaderboard[0]['callsign'])
+        self.rounds.append((race_id, heat_leaderboard, winner_callsign))
+        self.add_round(heat_leaderboard, 1)
+        if self.winners[winner_pilot_id]["wins"] > 1:
+            # race is over (Chase the Ace)
+            self.is_over = True
+
+    def rollback(self, round_index):
+        # remove the round and the ones after it, so they can be consumed again in order
+        while len(self.rounds) > round_index:
+            _, heat_leaderboard, _ = self.rounds.pop()
+            if heat_leaderboard and not self.is_iron_man:
+                self.add_round(heat_leaderboard, -1)
+            self.is_iron_man = False
+            self.is_over = False
+
+    def new_tally(self):
+        return {
+            "wins": 0,
+            "points": 0,
+            "places": [0] * self.size
+        }
+
+    def add_round(self, heat_leaderboard, sign):
+        # finals of any size, a round with more pilots than expected extends the places of every pilot
+        if len(heat_leaderboard) > self.size:
+            for tally in self.winners.values():
+                tally["places"].extend([0] * (len(heat_leaderboard)-self.size))
+            self.size = len(heat_leaderboard)
+
+        self.winners.setdefault(heat_leaderboard[0]['pilot_id'], self.new_tally())["wins"] += sign
+        for index, x in enumerate(heat_leaderboard):
+            tally = self.winners.setdefault(x['pilot_id'], self.new_tally())
+            tally["points"] += sign*(index+1)
+            tally["places"][index] += sign
+
+    def standings(self, bracket_type, qualifier_rank):
+        """ slots of the last round, ordered by the final ranking """
+        # the winner of the last round has won the final, the others are ordered by their tally
+        # in case of a tie, the result of the latest round is considered: sorting is stable and starts from its order
+        heat_leaderboard = self.last_leaderboard
+        others = list(heat_leaderboard[1:])
+        if bracket_type != CSI:
+            # MultiGP/FAI: the lowest sum of positions
+            others.sort(key=lambda x: self.winners[x['pilot_id']]["points"])
         else:
-            # unsupported format
-            return None
-    else:
-        # unsupported format
-        return None
+            # CSI: the most first places, then second places and so on, and in case of a tie the qualifier class is used as tiebreaker
+            others.sort(key=lambda x: ([-count for count in self.winners[x['pilot_id']]["places"]],
+                                       qualifier_rank.get(x['pilot_id'], MISSING_PILOT_RANK)))
+        return [heat_leaderboard[0]] + others
 
+    def update(self, races, heat_results, pilot_callsigns):
+        # roll back the first round that has been deleted or saved again
+        for round_index, (race_id, heat_leaderboard, _) in enumerate(self.rounds):
+            if round_index >= len(races) or races[round_index].id != race_id or \
+               heat_results.race_leaderboard(races[round_index]) is not heat_leaderboard:
+                self.rollback(round_index)
+                break
 
+        # consume new rounds until the race is over
+        for race in races[len(self.rounds):]:
+            if self.is_over:
+                break
+            self.consume(race.id, heat_results.race_leaderboard(race), pilot_callsigns)
 
-####################################################################################################
 
-def brackets(rhapi, race_class, args):
-    """ look for qualifier results """
-    if int(args["qualifier_class"]) == int(race_class.id):
-        logger.error(f"Failed building ranking: brackets cannot use themselves as qualifier class")
-        return {}, {}
+
+class DBCallCounter:
+    """ Proxy of rhapi.db counting the queries made during a ranking computation """
+    def __init__(self, db):
+        self._db = db
+        self.calls = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self._db, name)
+        if not callable(attribute):
+            # properties such as raceclasses, pilots or slots run their query when accessed
+            self.count(name)
+            return attribute
+
+        # methods are counted when called, so a method kept and called several times is counted each time
+        def counted_call(*args, **kwargs):
+            self.count(name)
+            return attribute(*args, **kwargs)
+        return counted_call
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+class InstrumentedRHAPI:
+    """ Proxy of rhapi whose database queries are counted """
+    def __init__(self, rhapi):
+        self._rhapi = rhapi
+        self.db = DBCallCounter(rhapi.db)
+
+    def __getattr__(self, name):
+        return getattr(self._rhapi, name)
+
+class RankingStats:
+    """ Database queries and time spent in each phase of a ranking computation """
+    def __init__(self, class_id, db_calls):
+        self.class_id = class_id
+        self.db_calls = db_calls
+        self.bracket_format = None
+        self.number_of_heats = None
+        self.cached = False
+        self.phases = {}
+        self._start = self._last = time.perf_counter()
+
+    def end_phase(self, name):
+        now = time.perf_counter()
+        self.phases[name] = round((now-self._last)*1000, 3)
+        self._last = now
+
+    def as_dict(self):
+        return {
+            'class_id': self.class_id,
+            'format': self.bracket_format.name if self.bracket_format else None,
+            'number_of_heats': self.number_of_heats,
+            'cached': self.cached,
+            'db_calls': dict(self.db_calls),
+            'db_calls_total': sum(self.db_calls.values()),
+            'phases_ms': dict(self.phases),
+            'total_ms': round((self._last-self._start)*1000, 3)
+        }
+
+# most recent ranking computations, for diagnostics during an event
+RANKING_STATS_SIZE = 200
+ranking_stats = deque(maxlen=RANKING_STATS_SIZE)
+
+def record_ranking_stats(stats):
+    stats.end_phase('output')
+    entry = stats.as_dict()
+    ranking_stats.append(entry)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Ranking of class {entry['class_id']}: format {entry['format']}, {entry['number_of_heats']} heats, "
+                     f"{'cached' if entry['cached'] else 'computed'} in {entry['total_ms']} ms {entry['phases_ms']}, "
+                     f"{entry['db_calls_total']} DB calls {entry['db_calls']}")
+    return entry
+
+def get_ranking_stats():
+    # aggregate recent computations by class, slowest classes first
+    classes = {}
+    for entry in ranking_stats:
+        aggregate = classes.setdefault(entry['class_id'], {
+            'class_id': entry['class_id'],
+            'format': entry['format'],
+            'number_of_heats': entry['number_of_heats'],
+            'rankings': 0,
+            'cached': 0,
+            'total_ms': 0,
+            'max_ms': 0,
+            'db_calls': 0
+        })
+        aggregate['format'] = entry['format'] or aggregate['format']
+        aggregate['number_of_heats'] = entry['number_of_heats'] or aggregate['number_of_heats']
+        aggregate['rankings'] += 1
+        aggregate['cached'] += 1 if entry['cached'] else 0
+        aggregate['total_ms'] += entry['total_ms']
+        aggregate['max_ms'] = max(aggregate['max_ms'], entry['total_ms'])
+        aggregate['db_calls'] += entry['db_calls_total']
+    return sorted(classes.values(), key=lambda x: x['total_ms'], reverse=True)
+
+
+
+# qualifier order and rank of each pilot, by qualifier class ID
+# the qualifier class is usually frozen during eliminations, so it is read again only when its results change
+qualifier_cache = {}
+
+def load_qualifier(rhapi, qualifier_class_id):
+    if qualifier_class_id in qualifier_cache:
+        return qualifier_cache[qualifier_class_id]
 
     qualifier_result = None
-    for raceclass in rhapi.db.raceclasses:
-        if int(raceclass.id) == int(args["qualifier_class"]):
-            qualifier_result = rhapi.db.raceclass_results(raceclass)
+    qualifier_class = rhapi.db.raceclass_by_id(qualifier_class_id)
+    if qualifier_class:
+        qualifier_result = rhapi.db.raceclass_results(qualifier_class)
 
     if not qualifier_result:
-        logger.error(f"Failed building ranking: qualifier result not available")
-        return {}, {}
+        # not cached, results may become available later
+        return None, None
 
     qualifier = qualifier_result[qualifier_result['meta']['primary_leaderboard']]
     # in general, leaderboards are already sorted by position, but sort them explicitly to be sure
     # however consider that pilots could be without a value for the "position" field (for example if they do not complete any laps),
     # handle this case by putting them at the end of the leaderboard
+    # results are shared with RotorHazard, so they are only read and never modified
     qualifier_with_position = [x for x in qualifier if x.get("position") is not None]
     qualifier_without_position = [x for x in qualifier if x.get("position") is None]
-    for i, element in enumerate(qualifier_without_position):
-        if not element.get("position"):
-            element["position"] = len(qualifier_with_position)+i+1
     # sort by position (to be safe) and extract only the pilot IDs
     qualifier = list(map(lambda x: x['pilot_id'], sorted(qualifier_with_position, key=lambda x: x['position']) + qualifier_without_position))
-    logger.info(f"Found {len(qualifier)} pilots in the qualifier class")
+    # position of each pilot in the qualifier class, shared by all tiebreakers
+    qualifier_rank = {pilot_id: rank for rank, pilot_id in enumerate(qualifier)}
 
-    """ build leaderboard """
-    heats = rhapi.db.heats_by_class(race_class.id)
-    NUMBER_OF_HEATS = len(heats)
+    qualifier_cache[qualifier_class_id] = (qualifier, qualifier_rank)
+    return qualifier, qualifier_rank
 
-    try:
-        leaderboard = build_leaderboard_generic(rhapi, heats, args["bracket_type"])
-    except Exception as e:
-        logger.error(f"Failed building ranking: an exception occurred while generating leaderboard ({e})")
+def is_slot_used(slot):
+    # heats have a slot for each node of the timer, seats left empty have no pilot and are not seeded from results
+    return slot.pilot_id != RHUtils.PILOT_ID_NONE or slot.method in (ProgramMethod.HEAT_RESULT, ProgramMethod.CLASS_RESULT)
+
+class BracketState:
+    """ Data of a bracket class kept between ranking computations and updated by race events """
+    def __init__(self, rhapi, class_id):
+        self.class_id = class_id
+        # heats without pilots hold no results and are not part of the bracket structure
+        heats = rhapi.db.heats_by_class(class_id)
+        slot_counts = Counter(slot.heat_id for slot in rhapi.db.slots if is_slot_used(slot))
+        self.ignored_heats = [heat for heat in heats if not slot_counts[heat.id]]
+        self.heat_results = HeatResultsCache(rhapi, class_id, [heat for heat in heats if slot_counts[heat.id]])
+        # structure of the class compared with the format: number of pilots assigned or seeded in each heat
+        self.structure = tuple(slot_counts[heat.id] for heat in self.heat_results.heats)
+        # format detected for each bracket type, None if the structure does not match any format
+        self.bracket_formats = {}
+        self.qualifier_class_id = None
+        self.bracket_format = None
+        self.chase_the_ace = None
+        # heats before the final already won by the TQ pilot, and the first heat the TQ pilot did not win
+        self.iron_man_tq_pilot_id = None
+        self.iron_man_verified_heats = 0
+        self.iron_man_lost_heat = None
+        self.ranking_key = None
+        self.ranking = None
+        # pilots seeded in the heats not raced yet, by heat number, for projections
+        self.heat_slots = {}
+
+    def invalidate_heat(self, heat_id, race_id=None):
+        # the Chase the Ace tally detects by itself which rounds of the final have changed
+        self.heat_results.invalidate_heat(heat_id, race_id)
+        self.ranking = None
+        # results may have been used to seed the next heats
+        self.heat_slots = {}
+        # Iron Man rule must be verified again from this heat, unless the TQ pilot has already lost an earlier heat
+        heat_number = self.heat_results.heat_number(heat_id)
+        if heat_number and (self.iron_man_lost_heat is None or heat_number <= self.iron_man_lost_heat):
+            self.iron_man_verified_heats = min(self.iron_man_verified_heats, heat_number-1)
+            self.iron_man_lost_heat = None
+
+    def detect_format(self, bracket_type):
+        # detected once, heat events replace the whole state
+        if bracket_type not in self.bracket_formats:
+            number_of_heats = len(self.structure)
+            # the final ranks as many pilots as it seats, a final of a single pilot is not considered
+            final_size = self.structure[-1] if self.structure and self.structure[-1] > 1 else None
+            bracket_format = get_bracket_format(bracket_type, number_of_heats, final_size)
+            if bracket_format:
+                logger.info(f"Format detected for class {self.class_id}: {bracket_format.description}")
+                # heats with missing pilots are still ranked, the positions coming from their empty places stay empty
+                expected = [HEAT_SLOTS] * (number_of_heats-1) + [bracket_format.final_size]
+                wrong_heats = [f"heat {heat_number} has {count} instead of {size}"
+                               for heat_number, (count, size) in enumerate(zip(self.structure, expected), start=1) if count != size]
+                if wrong_heats:
+                    logger.warning(f"Unexpected number of pilots in class {self.class_id}: {', '.join(wrong_heats)}")
+            else:
+                ignored = f", {len(self.ignored_heats)} heats without pilots ignored" if self.ignored_heats else ""
+                supported = ", ".join(f"{n} ({known_format.description})" for (known_type, n), known_format in sorted(BRACKET_FORMATS.items()) if known_type == bracket_type)
+                logger.error(f"Failed building ranking: unsupported format for class {self.class_id} ({bracket_type} brackets with {number_of_heats} heats{ignored}), "
+                             f"supported number of heats: {supported}")
+            self.bracket_formats[bracket_type] = bracket_format
+        return self.bracket_formats[bracket_type]
+
+    def is_iron_man_available(self, tq_pilot_id):
+        # verify that the pilot holding the TQ has won all heats before the final,
+        # heats already verified are not checked again and the check stops at the first heat the TQ pilot did not win
+        if self.iron_man_tq_pilot_id != tq_pilot_id:
+            self.iron_man_tq_pilot_id = tq_pilot_id
+            self.iron_man_verified_heats = 0
+            self.iron_man_lost_heat = None
+
+        if self.iron_man_lost_heat is None:
+            for heat_number in range(self.iron_man_verified_heats+1, len(self.heat_results.heats)):
+                heat_leaderboard = self.heat_results.leaderboard(heat_number)
+                if heat_leaderboard:
+                    pilot_ids = list(map(lambda x: x['pilot_id'], heat_leaderboard))
+                    winner_pilot_id = heat_leaderboard[0]['pilot_id']
+                    if tq_pilot_id in pilot_ids and winner_pilot_id != tq_pilot_id:
+                        self.iron_man_lost_heat = heat_number
+                        break
+                self.iron_man_verified_heats = heat_number
+
+        return self.iron_man_lost_heat is None
+
+# state of each bracket class, by class ID
+bracket_states = {}
+
+def get_bracket_state(rhapi, class_id):
+    if class_id not in bracket_states:
+        bracket_states[class_id] = BracketState(rhapi, class_id)
+    return bracket_states[class_id]
+
+# a single ranking computation at a time, worker included
+ranking_lock = threading.RLock()
+
+# invalidations received from event handlers, as (class ID, heat ID, race ID) with a class ID of None for all classes,
+# they are only recorded so that handlers never wait for a running computation, and applied by the next one
+invalidation_lock = threading.Lock()
+pending_invalidations = []
+
+def invalidate_class(class_id, heat_id=None, race_id=None):
+    with invalidation_lock:
+        pending_invalidations.append((class_id, heat_id, race_id))
+
+def invalidate_all():
+    with invalidation_lock:
+        # earlier invalidations are superseded
+        pending_invalidations[:] = [(None, None, None)]
+
+def apply_invalidations():
+    # called with ranking_lock held, before the states are read
+    with invalidation_lock:
+        invalidations = list(pending_invalidations)
+        pending_invalidations.clear()
+    for class_id, heat_id, race_id in invalidations:
+        if class_id is None:
+            qualifier_cache.clear()
+            bracket_states.clear()
+            continue
+        qualifier_cache.pop(class_id, None)
+        # brackets using this class as qualifier must be ranked again
+        for state in bracket_states.values():
+            if state.qualifier_class_id == class_id:
+                state.ranking = None
+        # if the heat is known, the other heats of the bracket class are still valid
+        if class_id in bracket_states:
+            if heat_id:
+                bracket_states[class_id].invalidate_heat(heat_id, race_id)
+            else:
+                del bracket_states[class_id]
+
+def is_invalidated(class_id, qualifier_class_id):
+    # results of the class or of its qualifier class have changed since the computation started
+    with invalidation_lock:
+        return any(pending_class_id in (None, class_id, qualifier_class_id) for pending_class_id, _, _ in pending_invalidations)
+
+
+
+# settings of the last completed ranking of each bracket class, used to rank it again in the background
+ranking_args = {}
+
+def ranked_classes(class_id=None):
+    """ bracket classes whose ranking depends on the class (all of them if not given) """
+    return [ranked_class_id for ranked_class_id, args in ranking_args.items()
+            if class_id is None or ranked_class_id == class_id or int(args['qualifier_class']) == class_id]
+
+DEFAULT_RECOMPUTE_WINDOW = 500  # ms
+
+class RankingScheduler:
+    """ Bracket classes invalidated by a burst of events are ranked again once, in the background, when the burst is over """
+    def __init__(self):
+        self.rhapi = None
+        self.dirty = set()
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def window(self):
+        try:
+            return int(self.rhapi.db.option('brackets_recompute_window')) / 1000
+        except (TypeError, ValueError):
+            return DEFAULT_RECOMPUTE_WINDOW / 1000
+
+    def mark_dirty(self, class_ids):
+        if not self.rhapi or not class_ids:
+            return
+        window = self.window()
+        if window <= 0:
+            # rankings are only computed on demand
+            return
+        with self.lock:
+            self.dirty.update(class_ids)
+            # events received before the timer expires are merged in the same recomputation
+            if not self.timer:
+                self.timer = threading.Timer(window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def take(self, class_id):
+        # the class is being ranked on demand, no need to rank it again in the background
+        with self.lock:
+            self.dirty.discard(class_id)
+
+    def flush(self):
+        with self.lock:
+            class_ids = self.dirty
+            self.dirty = set()
+            self.timer = None
+        classes = []
+        for class_id in sorted(class_ids):
+            try:
+                args = ranking_args.get(class_id)
+                race_class = self.rhapi.db.raceclass_by_id(class_id) if args else None
+            except Exception as e:
+                logger.error(f"Failed ranking class {class_id} in the background ({e})")
+                continue
+            if race_class:
+                classes.append((race_class, args))
+        # qualifier results and pilots are loaded once for the whole burst, a failing class doesn't stop the others
+        rank_brackets(self.rhapi, classes)
+
+scheduler = RankingScheduler()
+
+
+
+SNAPSHOTS_OPTION = 'brackets_snapshots'
+SNAPSHOTS_SAVE_DELAY = 2  # s, 0 to write them at once
+
+class SnapshotStore:
+    """ Last standings of each bracket class, saved in the plugin options to be served right after a restart
+
+    Changes are kept in memory and written once, in the background, for a whole burst of saved races.
+    """
+    def __init__(self):
+        self.rhapi = None
+        self._snapshots = None
+        self.pending = False
+        self.timer = None
+        self.lock = threading.Lock()
+        # writes are made one at a time, each with the latest snapshots
+        self.write_lock = threading.Lock()
+
+    def snapshots(self):
+        # loaded once, then kept in memory and written back by flush
+        if self._snapshots is None:
+            try:
+                self._snapshots = {int(class_id): snapshot for class_id, snapshot in json.loads(self.rhapi.db.option(SNAPSHOTS_OPTION) or '{}').items()}
+            except (TypeError, ValueError):
+                self._snapshots = {}
+        return self._snapshots
+
+    def save(self):
+        # called with the lock held, the write is only scheduled so that race save handlers don't wait for it
+        self.pending = True
+        if SNAPSHOTS_SAVE_DELAY > 0 and not self.timer:
+            self.timer = threading.Timer(SNAPSHOTS_SAVE_DELAY, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        # write the pending changes, if any
+        with self.write_lock:
+            with self.lock:
+                if self.timer:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.pending:
+                    return
+                self.pending = False
+                data = json.dumps(self._snapshots)
+            self.rhapi.db.option_set(SNAPSHOTS_OPTION, data)
+
+    def flush_without_delay(self):
+        # without delay, changes are written at once
+        if SNAPSHOTS_SAVE_DELAY <= 0:
+            self.flush()
+
+    def get(self, class_id, fingerprint):
+        if not self.rhapi:
+            return None
+        with self.lock:
+            snapshot = self.snapshots().get(class_id)
+        if snapshot and snapshot['fingerprint'] == fingerprint:
+            return snapshot['leaderboard'], snapshot['meta']
+        return None
+
+    def put(self, class_id, qualifier_class_id, fingerprint, ranking):
+        if not self.rhapi:
+            return
+        leaderboard, meta = ranking
+        snapshot = {
+            'qualifier_class': qualifier_class_id,
+            'fingerprint': fingerprint,
+            'leaderboard': leaderboard,
+            'meta': meta
+        }
+        with self.lock:
+            # a recomputation giving the same standings does not rewrite the options store
+            if self.snapshots().get(class_id) == snapshot:
+                return
+            self.snapshots()[class_id] = snapshot
+            self.save()
+        self.flush_without_delay()
+
+    def discard(self, class_id=None):
+        # snapshots of the class and of brackets using it as qualifier (all of them if not given)
+        if not self.rhapi:
+            return
+        with self.lock:
+            snapshots = self.snapshots()
+            class_ids = [snapshot_class_id for snapshot_class_id, snapshot in snapshots.items()
+                         if class_id is None or snapshot_class_id == class_id or snapshot['qualifier_class'] == class_id]
+            if class_ids:
+                for snapshot_class_id in class_ids:
+                    del snapshots[snapshot_class_id]
+                self.save()
+        self.flush_without_delay()
+
+    def clear(self):
+        # snapshots in a replaced database are not trusted, class and race ids may be reused
+        if not self.rhapi:
+            return
+        with self.lock:
+            self._snapshots = {}
+            self.save()
+        self.flush_without_delay()
+
+snapshots = SnapshotStore()
+
+def ranking_fingerprint(rhapi, heat_results, qualifier_class_id, ranking_key):
+    """ identifies the heats and races a ranking is computed from """
+    races = [race for heat_number in range(1, len(heat_results.heats)+1) for race in heat_results.races(heat_number)]
+    races += rhapi.db.races_by_raceclass(qualifier_class_id)
+    data = (ranking_key,
+            [heat.id for heat in heat_results.heats],
+            [(race.id, race.heat_id, race.round_id, getattr(race, 'start_time_formatted', None)) for race in races])
+    return hashlib.sha1(repr(data).encode()).hexdigest()
+
+
+
+# standings and Chase the Ace tally last pushed to the clients, by class ID
+published_progression = {}
+
+def publish_progression(rhapi, class_id, leaderboard, cta):
+    """ push the positions and Chase the Ace tally that have changed since the last push of the class """
+    positions = {x['position']: (x['pilot_id'], x['callsign'], x['team_name'], x['result']) for x in leaderboard}
+    tally = None
+    if cta:
+        tally = {
+            'tally': [{'pilot_id': pilot_id, 'wins': x['wins'], 'points': x['points'], 'places': list(x['places'])}
+                      for pilot_id, x in cta.winners.items()],
+            'winners': cta.winners_names,
+            'is_over': cta.is_over,
+            'is_iron_man': cta.is_iron_man
+        }
+
+    last_positions, last_tally = published_progression.get(class_id, ({}, None))
+    changed = [position for position, x in positions.items() if last_positions.get(position) != x]
+    removed = [position for position in last_positions if position not in positions]
+    if not changed and not removed and tally == last_tally:
+        return
+    published_progression[class_id] = (positions, tally)
+
+    rhapi.ui.socket_broadcast('brackets_progression', {
+        'class_id': class_id,
+        'positions': [{
+            'position': position,
+            'pilot_id': positions[position][0],
+            'callsign': positions[position][1],
+            'team_name': positions[position][2],
+            'result': positions[position][3]
+        } for position in sorted(changed)],
+        'removed': sorted(removed),
+        'chase_the_ace': tally
+    })
+
+####################################################################################################
+
+def brackets(rhapi, race_class, args):
+    return rank_brackets(rhapi, [(race_class, args)])[race_class.id]
+
+def rank_brackets(rhapi, classes):
+    """ rank several bracket classes together, classes is a list of (race class, ranking args)
+
+    Qualifier results and pilot callsigns are loaded once for all of them.
+    Returns the (leaderboard, meta) of each class, by class ID.
+    """
+    pilot_callsigns = PilotCallsigns(rhapi)
+    rankings = {}
+    # if a class is being ranked in the background, wait for it and get its result
+    for race_class, _ in classes:
+        scheduler.take(race_class.id)
+    with ranking_lock:
+        for race_class, args in classes:
+            try:
+                rankings[race_class.id] = compute_brackets(rhapi, race_class, args, pilot_callsigns)
+            except Exception as e:
+                logger.error(f"Failed building ranking for class {race_class.id} ({e})")
+                # the state may be partially updated, the next ranking starts over
+                bracket_states.pop(race_class.id, None)
+                rankings[race_class.id] = {}, {}
+    return rankings
+
+def ranking_output(ranking, args, count, stats_entry):
+    # the first count positions if given, with the statistics of this call if enabled
+    # kept and saved rankings are never modified, so they don't carry the statistics of a previous call
+    leaderboard, meta = ranking
+    if count is not None:
+        leaderboard = [x for x in leaderboard if x['position'] <= count]
+    if 'statistics' in args and args['statistics']:
+        meta = dict(meta, brackets_stats=stats_entry)
+    return leaderboard, meta
+
+def top_brackets(rhapi, race_class, args, count):
+    """ first count positions of the ranking, computed from the heats these positions come from if not cached """
+    with ranking_lock:
+        return compute_brackets(rhapi, race_class, args, PilotCallsigns(rhapi), count)
+
+def compute_brackets(rhapi, race_class, args, pilot_callsigns, count=None):
+    """ look for qualifier results """
+    if int(args["qualifier_class"]) == int(race_class.id):
+        logger.error(f"Failed building ranking: brackets cannot use themselves as qualifier class")
         return {}, {}
 
-    if not leaderboard:
-        logger.error(f"Failed building ranking: unsupported format (" + args["bracket_type"] + " brackets with " + str(len(heats)) + " heats)")
+    # database queries and time spent in each phase are recorded
+    rhapi = InstrumentedRHAPI(rhapi)
+    stats = RankingStats(race_class.id, rhapi.db.calls)
+
+    # nothing has changed since the last computation
+    apply_invalidations()
+    state = get_bracket_state(rhapi, race_class.id)
+    state.heat_results.rhapi = rhapi
+    ranking_key = tuple(sorted(args.items()))
+    if state.ranking and state.ranking_key == ranking_key:
+        stats.cached = True
+        stats.bracket_format = state.bracket_format
+        stats.number_of_heats = len(state.heat_results.heats)
+        return ranking_output(state.ranking, args, count, record_ranking_stats(stats))
+
+    # the structure of the class is checked only once, mis-structured classes are reported once
+    bracket_format = state.detect_format(args["bracket_type"])
+    if not bracket_format:
         return {}, {}
 
-    """ apply qualifier results to resolve ties """
-    try:
-        apply_tiebreaker_generic(leaderboard, qualifier, NUMBER_OF_HEATS, args["bracket_type"])
-    except Exception as e:
-        logger.error(f"Failed building ranking: an exception occurred while resolving ties ({e})")
+    # standings saved before a restart are served if no heat or race has changed since
+    fingerprint = ranking_fingerprint(rhapi, state.heat_results, int(args["qualifier_class"]), ranking_key)
+    ranking = snapshots.get(race_class.id, fingerprint) if state.ranking_key is None else None
+    if ranking:
+        state.qualifier_class_id = int(args["qualifier_class"])
+        state.bracket_format = bracket_format
+        state.ranking_key = ranking_key
+        state.ranking = ranking
+        ranking_args[race_class.id] = dict(args)
+        stats.cached = True
+        stats.bracket_format = state.bracket_format
+        stats.number_of_heats = len(state.heat_results.heats)
+        return ranking_output(ranking, args, count, record_ranking_stats(stats))
+
+    qualifier, qualifier_rank = load_qualifier(rhapi, int(args["qualifier_class"]))
+    if qualifier is None:
+        logger.error(f"Failed building ranking: qualifier result not available")
         return {}, {}
+    logger.info(f"Found {len(qualifier)} pilots in the qualifier class")
+    state.qualifier_class_id = int(args["qualifier_class"])
+    stats.end_phase('qualifier')
+
+    """ build leaderboard """
+    # results of each heat are shared by leaderboard, Iron Man rule and final heat,
+    # and they are kept until a race of the heat is saved
+    heat_results = state.heat_results
+    heats = heat_results.heats
+    NUMBER_OF_HEATS = len(heats)
+    logger.info(f"Found {NUMBER_OF_HEATS} heats in the bracket class")
+    state.bracket_format = bracket_format
+    stats.bracket_format = bracket_format
+    stats.number_of_heats = NUMBER_OF_HEATS
+
+    # positions are read from the heat results and their ties resolved only when needed
+    leaderboard = LazyLeaderboard(heat_results, bracket_format, qualifier_rank)
 
     """ apply Chase the Ace and Iron Man rule """
-    if 'chase_the_ace' in args and args['chase_the_ace']:
+    # until the final has been raced, top positions stay empty and there is nothing to verify
+    cta = None
+    final_raced = heat_results.is_raced(NUMBER_OF_HEATS)
+    if final_raced and 'chase_the_ace' in args and args['chase_the_ace']:
+        # shared by winner notifications and alerts of all classes ranked together, pilots are loaded only if a name is needed
+        pilot_callsigns.rhapi = rhapi
+
         # verify if Iron Man rule can be applied
         if 'iron_man' in args and args['iron_man']:
-            IS_IRON_MAN_AVAILABLE = True
-            tq_pilot_id = qualifier[0]
-
-            # verify that the pilot holding the TQ has won all heats before the final
-            for heat in heats[:-1]:
-                # for robustness, don't use heat_results but get results from Round 1 instead
-                races = rhapi.db.races_by_heat(heat.id)
-                if races:
-                    race_result = rhapi.db.race_results(races[0])
-                    if race_result:
-                        heat_leaderboard = race_result[race_result['meta']['primary_leaderboard']]
-                        pilot_ids = list(map(lambda x: x['pilot_id'], heat_leaderboard))
-                        winner_pilot_id = heat_leaderboard[0]['pilot_id']
-                        if tq_pilot_id in pilot_ids and winner_pilot_id != tq_pilot_id:
-                            IS_IRON_MAN_AVAILABLE = False
-                            break
+            # kept up to date as heats are saved
+            IS_IRON_MAN_AVAILABLE = state.is_iron_man_available(qualifier[0])
         else:
             IS_IRON_MAN_AVAILABLE = False
 
-        # initialize data for each pilot in the final
-        slots = rhapi.db.slots_by_heat(heats[-1].id)
-        winners = {}
-        for slot in slots:
-            pilot_id = slot.pilot_id
-            winners[pilot_id] = {
-                "wins": 0,
-                "points": 0,
-                "big_points": 0
-            }
-
-        winners_names = []
-        RACE_IS_OVER = False
-
-        # extract rounds from the final
-        races = rhapi.db.races_by_heat(heats[-1].id)
-        for race_number, race in enumerate(races):
-            race_result = rhapi.db.race_results(race)
+        # the tally of the final is kept between computations, so only new rounds are read
+        tq_pilot_id = qualifier[0] if IS_IRON_MAN_AVAILABLE else None
+        cta = state.chase_the_ace
+        if not cta or cta.is_iron_man_available != IS_IRON_MAN_AVAILABLE or cta.tq_pilot_id != tq_pilot_id:
+            # only the finalists, empty node slots are left out
+            slots = rhapi.db.slots_by_heat(heats[-1].id)
+            cta = ChaseTheAce([slot.pilot_id for slot in slots if slot.pilot_id != RHUtils.PILOT_ID_NONE], tq_pilot_id, IS_IRON_MAN_AVAILABLE)
+            state.chase_the_ace = cta
+        cta.update(heat_results.races(NUMBER_OF_HEATS), heat_results, pilot_callsigns)
+        winners = cta.winners
 
-            if race_result:
-                heat_leaderboard = race_result[race_result['meta']['primary_leaderboard']]
-                winner_pilot_id = heat_leaderboard[0]['pilot_id']
-
-                if race_number == 0 and IS_IRON_MAN_AVAILABLE and winner_pilot_id == tq_pilot_id:
-                    # race is over (Iron Man)
-                    leaderboard[0] = build_leaderboard_object(rhapi, 1, heats, NUMBER_OF_HEATS, 1, "CTA [1] [1]")
-                    leaderboard[1] = build_leaderboard_object(rhapi, 2, heats, NUMBER_OF_HEATS, 2, "[2] [2]")
-                    leaderboard[2] = build_leaderboard_object(rhapi, 3, heats, NUMBER_OF_HEATS, 3, "[3] [3]")
-                    leaderboard[3] = build_leaderboard_object(rhapi, 4, heats, NUMBER_OF_HEATS, 4, "[4] [4]")
-                    rhapi.ui.message_alert(rhapi.__('Iron Man Winner: {}').format(leaderboard[0]['callsign']))
-                    RACE_IS_OVER = True
-                    break
-
-                winners[winner_pilot_id]["wins"] += 1
-                winners_names.append(rhapi.db.pilot_by_id(winner_pilot_id).display_callsign)
-
-                winners[heat_leaderboard[0]['pilot_id']]["points"] += 1
-                winners[heat_leaderboard[1]['pilot_id']]["points"] += 2
-                winners[heat_leaderboard[2]['pilot_id']]["points"] += 3
-                winners[heat_leaderboard[3]['pilot_id']]["points"] += 4
-
-                winners[heat_leaderboard[0]['pilot_id']]["big_points"] += 1000
-                winners[heat_leaderboard[1]['pilot_id']]["big_points"] += 100
-                winners[heat_leaderboard[2]['pilot_id']]["big_points"] += 10
-                winners[heat_leaderboard[3]['pilot_id']]["big_points"] += 1
-
-                RACE_IS_OVER = False
-                for pilot_id in winners:
-                    if winners[pilot_id]["wins"] > 1:
-                        # race is over (Chase the Ace)
-                        RACE_IS_OVER = True
-                        break
-                if RACE_IS_OVER:
-                    if args["bracket_type"] != CSI:
-                        # positions from second to fourth are point based
-                        # in case of a tie, the result of the latest heat is considered
-                        # the smartest way to implement this is take the leaderboard of the last heat and order it by points using Bubblesort as sorting algorithm
-                        # it makes sense because Bubblesort does not alter the order of items that are equal 
-                        # and it is efficient since we have to order only three elements :)
-                        if winners[heat_leaderboard[1]['pilot_id']]["points"] > winners[heat_leaderboard[2]['pilot_id']]["points"]:
-                            heat_leaderboard[1], heat_leaderboard[2] = heat_leaderboard[2], heat_leaderboard[1]
-                        if winners[heat_leaderboard[2]['pilot_id']]["points"] > winners[heat_leaderboard[3]['pilot_id']]["points"]:
-                            heat_leaderboard[2], heat_leaderboard[3] = heat_leaderboard[3], heat_leaderboard[2]
-                        if winners[heat_leaderboard[1]['pilot_id']]["points"] > winners[heat_leaderboard[2]['pilot_id']]["points"]:
-                            heat_leaderboard[1], heat_leaderboard[2] = heat_leaderboard[2], heat_leaderboard[1]
-                        if winners[heat_leaderboard[2]['pilot_id']]["points"] > winners[heat_leaderboard[3]['pilot_id']]["points"]:
-                            heat_leaderboard[2], heat_leaderboard[3] = heat_leaderboard[3], heat_leaderboard[2]
-                        # build top-4 leaderboard
-                        leaderboard[0] = build_leaderboard_object_basic(rhapi, 1, heat_leaderboard[0], f"CTA [{winners[heat_leaderboard[0]['pilot_id']]['points']}] [1]")
-                        leaderboard[1] = build_leaderboard_object_basic(rhapi, 2, heat_leaderboard[1], f"[{winners[heat_leaderboard[1]['pilot_id']]['points']}] [2]")
-                        leaderboard[2] = build_leaderboard_object_basic(rhapi, 3, heat_leaderboard[2], f"[{winners[heat_leaderboard[2]['pilot_id']]['points']}] [3]")
-                        leaderboard[3] = build_leaderboard_object_basic(rhapi, 4, heat_leaderboard[3], f"[{winners[heat_leaderboard[3]['pilot_id']]['points']}] [4]")
-                    else:
-                        # CSI ranking is similar to MultiGP/FAI, but points are different and, in case of a tie, qualifier class is used as tiebreaker
-                        if winners[heat_leaderboard[1]['pilot_id']]["big_points"] < winners[heat_leaderboard[2]['pilot_id']]["big_points"]:
-                            heat_leaderboard[1], heat_leaderboard[2] = heat_leaderboard[2], heat_leaderboard[1]
-                        if winners[heat_leaderboard[2]['pilot_id']]["big_points"] < winners[heat_leaderboard[3]['pilot_id']]["big_points"]:
-                            heat_leaderboard[2], heat_leaderboard[3] = heat_leaderboard[3], heat_leaderboard[2]
-                        if winners[heat_leaderboard[1]['pilot_id']]["big_points"] < winners[heat_leaderboard[2]['pilot_id']]["big_points"]:
-                            heat_leaderboard[1], heat_leaderboard[2] = heat_leaderboard[2], heat_leaderboard[1]
-                        if winners[heat_leaderboard[2]['pilot_id']]["big_points"] < winners[heat_leaderboard[3]['pilot_id']]["big_points"]:
-                            heat_leaderboard[2], heat_leaderboard[3] = heat_leaderboard[3], heat_leaderboard[2]
-                        # build temporary top-4 leaderboard (ties have not been solved yet)
-                        leaderboard[0] = build_leaderboard_object_basic(rhapi, 1, heat_leaderboard[0], "")
-                        leaderboard[1] = build_leaderboard_object_basic(rhapi, 2, heat_leaderboard[1], "")
-                        leaderboard[2] = build_leaderboard_object_basic(rhapi, 3, heat_leaderboard[2], "")
-                        leaderboard[3] = build_leaderboard_object_basic(rhapi, 4, heat_leaderboard[3], "")
-                        # look for ties and solve them
-                        if winners[heat_leaderboard[1]['pilot_id']]["big_points"] == winners[heat_leaderboard[2]['pilot_id']]["big_points"] and \
-                           winners[heat_leaderboard[1]['pilot_id']]["big_points"] == winners[heat_leaderboard[3]['pilot_id']]["big_points"]:
-                            apply_tiebreaker(leaderboard, qualifier, 2, 4)
-                        elif winners[heat_leaderboard[1]['pilot_id']]["big_points"] == winners[heat_leaderboard[2]['pilot_id']]["big_points"]:
-                            apply_tiebreaker(leaderboard, qualifier, 2, 3)
-                        elif winners[heat_leaderboard[2]['pilot_id']]["big_points"] == winners[heat_leaderboard[3]['pilot_id']]["big_points"]:
-                            apply_tiebreaker(leaderboard, qualifier, 3, 4)
-                        # update top-4 leaderboard
-                        leaderboard[0]["result"] = "CTA [1] [1]"
-                        leaderboard[1]["result"] = "[2] [2]"
-                        leaderboard[2]["result"] = "[3] [3]"
-                        leaderboard[3]["result"] = "[4] [4]"
-
-                    rhapi.ui.message_alert(rhapi.__('Chase the Ace Winner: {}').format(leaderboard[0]['callsign']))
-
-                    break
-
-        if not RACE_IS_OVER and len(winners_names) > 0:
-            rhapi.ui.message_notify(rhapi.__('Wins: {}').format(', '.join(winners_names)))
-    else:
+        if cta.is_iron_man:
+            # race is over (Iron Man)
+            for position in range(1, bracket_format.final_size+1):
+                leaderboard[position-1] = build_leaderboard_object(heat_results, position, NUMBER_OF_HEATS, position, f"[{position}] [{position}]")
+            if leaderboard[0]:
+                leaderboard[0].result = "CTA " + leaderboard[0].result
+            rhapi.ui.message_alert(rhapi.__('Iron Man Winner: {}').format(pilot_callsigns.get(leaderboard[0].pilot_id, leaderboard[0].callsign)))
+        elif cta.is_over:
+            # race is over (Chase the Ace)
+            for position, slot in enumerate(cta.standings(args["bracket_type"], qualifier_rank)[:bracket_format.final_size], start=1):
+                if args["bracket_type"] != CSI:
+                    result = f"[{winners[slot['pilot_id']]['points']}] [{position}]"
+                else:
+                    result = f"[{position}] [{position}]"
+                if position == 1:
+                    result = "CTA " + result
+                leaderboard[position-1] = build_leaderboard_object_basic(rhapi, position, slot, result)
+
+            rhapi.ui.message_alert(rhapi.__('Chase the Ace Winner: {}').format(pilot_callsigns.get(leaderboard[0].pilot_id, leaderboard[0].callsign)))
+        elif len(cta.winners_names) > 0:
+            rhapi.ui.message_notify(rhapi.__('Wins: {}').format(', '.join(cta.winners_names)))
+    elif final_raced:
         # if CTA is disabled, just use the results of the last heat
-        leaderboard[0] = build_leaderboard_object(rhapi, 1, heats, NUMBER_OF_HEATS, 1, "1° in Final")
-        leaderboard[1] = build_leaderboard_object(rhapi, 2, heats, NUMBER_OF_HEATS, 2, "2° in Final")
-        leaderboard[2] = build_leaderboard_object(rhapi, 3, heats, NUMBER_OF_HEATS, 3, "3° in Final")
-        leaderboard[3] = build_leaderboard_object(rhapi, 4, heats, NUMBER_OF_HEATS, 4, "4° in Final")
+        for position in range(1, bracket_format.final_size+1):
+            leaderboard[position-1] = build_leaderboard_object(heat_results, position, NUMBER_OF_HEATS, position, f"{position}° in Final")
 
-    """ remove empty slots """
-    leaderboard = list(filter(lambda x: x != None, leaderboard))
+    stats.end_phase('cta')
+
+    """ remove empty slots and convert to the format expected by RotorHazard """
+    try:
+        leaderboard = [entry.as_dict() for entry in leaderboard.materialize(count) if entry]
+    except Exception as e:
+        logger.error(f"Failed building ranking: an exception occurred while generating leaderboard ({e})")
+        return {}, {}
+    stats.end_phase('leaderboard')
 
     meta = {
         'rank_fields': [{
@@ -667,24 +1130,188 @@ def brackets(rhapi, race_class, args):
         }]
     }
 
-    return leaderboard, meta
+    stats_entry = record_ranking_stats(stats)
+    if count is not None:
+        # partial rankings are not kept
+        return ranking_output((leaderboard, meta), args, count, stats_entry)
+
+    ranking_args[race_class.id] = dict(args)
+    if is_invalidated(race_class.id, state.qualifier_class_id):
+        # results changed during the computation, the ranking is returned but not kept, saved or pushed
+        return ranking_output((leaderboard, meta), args, None, stats_entry)
+    state.ranking_key = ranking_key
+    state.ranking = (leaderboard, meta)
+    snapshots.put(race_class.id, state.qualifier_class_id, fingerprint, state.ranking)
+    publish_progression(rhapi, race_class.id, leaderboard, cta)
+    return ranking_output(state.ranking, args, None, stats_entry)
+
+class HypotheticalHeatResults:
+    """ Heat results with the finish order of some heats replaced, the other heats are read from the loaded results """
+    def __init__(self, heat_results, leaderboards):
+        self.heat_results = heat_results
+        self.heats = heat_results.heats
+        self._leaderboards = leaderboards
+
+    def leaderboard(self, heat_number):
+        if heat_number in self._leaderboards:
+            return self._leaderboards[heat_number]
+        return self.heat_results.leaderboard(heat_number)
+
+def what_if_brackets(rhapi, race_class, args, finish_orders):
+    """ standings of the bracket class if the heats in finish_orders ended in the given order
+
+    finish_orders maps heat numbers (1-based) to the pilot IDs of the heat in finish order.
+    No race is read again: only the positions coming from the given heats change, and the final
+    keeps its current standings unless it is one of the given heats (Chase the Ace is not simulated).
+    """
+    brackets(rhapi, race_class, args)
+    with ranking_lock:
+        apply_invalidations()
+        state = bracket_states.get(race_class.id)
+        if not state or not state.ranking:
+            return []
+        qualifier, qualifier_rank = load_qualifier(rhapi, state.qualifier_class_id)
+        if qualifier is None:
+            return []
+
+        pilots = {pilot.id: pilot for pilot in rhapi.db.pilots}
+        leaderboards = {}
+        for heat_number, pilot_ids in finish_orders.items():
+            leaderboards[int(heat_number)] = [{
+                'pilot_id': pilot_id,
+                'callsign': pilots[pilot_id].callsign if pilot_id in pilots else "",
+                'team_name': pilots[pilot_id].team if pilot_id in pilots else ""
+            } for pilot_id in pilot_ids]
+        heat_results = HypotheticalHeatResults(state.heat_results, leaderboards)
+
+        leaderboard = LazyLeaderboard(heat_results, state.bracket_format, qualifier_rank).materialize()
+
+        number_of_heats = len(heat_results.heats)
+        if number_of_heats in leaderboards:
+            for position in range(1, state.bracket_format.final_size+1):
+                leaderboard[position-1] = build_leaderboard_object(heat_results, position, number_of_heats, position, f"{position}° in Final")
+        else:
+            for x in state.ranking[0]:
+                if x['position'] <= state.bracket_format.final_size:
+                    leaderboard[x['position']-1] = LeaderboardEntry(x, x['position'], x['result'])
+
+    return [entry.as_dict() for entry in leaderboard if entry]
+
+def project_brackets(rhapi, race_class, args):
+    """ for each position of the bracket class, whether it is already decided and the pilots that can still get it
+
+    Positions resolved by a tiebreak are decided once all heats of the tiebreak have been raced.
+    Pilots of a heat not raced yet are its seeded pilots, or all pilots still in the bracket if it is not seeded yet.
+    """
+    ranking, _ = brackets(rhapi, race_class, args)
+    with ranking_lock:
+        apply_invalidations()
+        state = bracket_states.get(race_class.id)
+        if not state or not state.ranking:
+            return []
+        qualifier, qualifier_rank = load_qualifier(rhapi, state.qualifier_class_id)
+        if qualifier is None:
+            return []
+
+        bracket_format = state.bracket_format
+        heat_results = state.heat_results
+        heats = heat_results.heats
+        current = {x['position']: x['pilot_id'] for x in ranking}
+
+        # pilots that will get each position from the heats already raced
+        decided = {}
+        for position, heat_number, heat_position, _ in bracket_format.positions:
+            heat_leaderboard = heat_results.leaderboard(heat_number)
+            if heat_leaderboard is not None:
+                decided[position] = heat_leaderboard[heat_position-1]['pilot_id'] if heat_position <= len(heat_leaderboard) else None
+        bracket_size = bracket_format.final_size + len(bracket_format.positions)
+        alive = set(qualifier[:bracket_size]) - set(decided.values())
+
+        def heat_candidates(heat_number):
+            # empty node slots are left out, seeded slots have no pilot until the heats seeding them are raced
+            if heat_number not in state.heat_slots:
+                state.heat_slots[heat_number] = [slot.pilot_id for slot in rhapi.db.slots_by_heat(heats[heat_number-1].id) if is_slot_used(slot)]
+            pilot_ids = state.heat_slots[heat_number]
+            if pilot_ids and all(pilot_ids):
+                return set(pilot_ids)
+            return alive
+
+        groups = {}
+        for first_position, second_position in bracket_format.tiebreakers:
+            for position in range(first_position, second_position+1):
+                groups[position] = range(first_position, second_position+1)
+
+        projection = []
+        for position in range(1, bracket_format.final_size+1):
+            locked = position in current
+            projection.append((position, locked, {current[position]} if locked else heat_candidates(len(heats))))
+        heat_of_position = {position: heat_number for position, heat_number, _, _ in bracket_format.positions}
+        for position, _, _, _ in bracket_format.positions:
+            candidates = set()
+            locked = True
+            for group_position in groups.get(position, [position]):
+                if group_position in decided:
+                    if decided[group_position]:
+                        candidates.add(decided[group_position])
+                else:
+                    locked = False
+                    candidates |= heat_candidates(heat_of_position[group_position])
+            if locked:
+                candidates = {current[position]} if position in current else set()
+            projection.append((position, locked, candidates))
+
+    return [{
+        'position': position,
+        'locked': locked,
+        'pilot_id': current.get(position) if locked else None,
+        'candidates': sorted(candidates, key=lambda pilot_id: qualifier_rank.get(pilot_id, MISSING_PILOT_RANK))
+    } for position, locked, candidates in projection]
 
 ####################################################################################################
 
 
 
+# names shown in the qualifier class selector, by class ID
+class_names = None
+
+def class_option_name(race_class):
+    if not race_class.name:
+        return f"Class {race_class.id}"
+    return race_class.name
+
+def update_class_names(rhapi, args):
+    """ returns True if the qualifier class selector has changed """
+    global class_names
+
+    class_id = args.get('class_id') if args else None
+    if class_names is None or not class_id:
+        names = {this_class.id: class_option_name(this_class) for this_class in rhapi.db.raceclasses}
+        if names == class_names:
+            return False
+        class_names = names
+        return True
+
+    # only the class of the event may have changed
+    class_id = int(class_id)
+    race_class = rhapi.db.raceclass_by_id(class_id)
+    name = class_option_name(race_class) if race_class else None
+    if class_names.get(class_id) == name:
+        return False
+    if name is None:
+        del class_names[class_id]
+    else:
+        class_names[class_id] = name
+    return True
+
 class_rank_method = None
 def register_handlers(rhapi, args):
     global class_rank_method
 
-    classes = rhapi.db.raceclasses
-    options = []
-    for this_class in classes:
-        if not this_class.name:
-            name = f"Class {this_class.id}"
-        else:
-            name = this_class.name
-        options.append(UIFieldSelectOption(this_class.id, name))
+    # rank settings or other fields of a class have changed, selector is still valid
+    if not update_class_names(rhapi, args) and class_rank_method:
+        return
+
+    options = [UIFieldSelectOption(class_id, name) for class_id, name in class_names.items()]
     if len(options) > 0:
         default_class = options[0].value
     else:
@@ -699,6 +1326,7 @@ def register_handlers(rhapi, args):
                 'qualifier_class': default_class,
                 'chase_the_ace': True,
                 'iron_man': True,
+                'statistics': False,
             },
             [
                 UIField('bracket_type',
@@ -725,6 +1353,11 @@ def register_handlers(rhapi, args):
                     UIFieldType.CHECKBOX,
                     value=True,
                     desc="Apply the Iron Man rule in the final heat (CTA is required)"),
+                UIField('statistics',
+                    "Ranking statistics",
+                    UIFieldType.CHECKBOX,
+                    value=False,
+                    desc="Include database calls and computation time in the results metadata"),
             ]
         )
         args['register_fn'](class_rank_method)
@@ -732,11 +1365,101 @@ def register_handlers(rhapi, args):
         # update class selector if the rank has been already initialized
         class_rank_method.settings[1].options = options
 
+def on_class_change(rhapi, args):
+    # rank settings or heats of the class may have changed
+    if args and args.get('class_id'):
+        class_id = int(args['class_id'])
+        invalidate_class(class_id)
+        snapshots.discard(class_id)
+        # the class itself is ranked on demand, with its new settings
+        ranking_args.pop(class_id, None)
+        published_progression.pop(class_id, None)
+        scheduler.mark_dirty(ranked_classes(class_id))
+    else:
+        invalidate_all()
+        snapshots.discard()
+        ranking_args.clear()
+    register_handlers(rhapi, args)
+
+def on_race_change(rhapi, args):
+    # a saved race has been added or modified, only its class is affected
+    race = None
+    if args and args.get('race_id'):
+        race = rhapi.db.race_by_id(args['race_id'])
+    if race:
+        invalidate_class(race.class_id, race.heat_id, race.id)
+        snapshots.discard(race.class_id)
+        scheduler.mark_dirty(ranked_classes(race.class_id))
+    else:
+        invalidate_all()
+        snapshots.discard()
+        scheduler.mark_dirty(ranked_classes())
+
+def on_data_reset(rhapi, args):
+    # heats added, moved between classes or deleted, pilots renamed, races deleted or results cache cleared
+    invalidate_all()
+    snapshots.discard()
+    scheduler.mark_dirty(ranked_classes())
+
+def on_database_change(rhapi, args):
+    global class_names
+
+    # database replaced, class ids may now refer to different classes
+    invalidate_all()
+    snapshots.clear()
+    ranking_args.clear()
+    published_progression.clear()
+    class_names = None
+    if class_rank_method:
+        register_handlers(rhapi, None)
+
+def show_ranking_stats(rhapi, args=None):
+    entries = get_ranking_stats()
+    if not entries:
+        rhapi.ui.message_notify(rhapi.__('No bracket rankings computed yet'))
+        return
+    for entry in entries:
+        message = f"Class {entry['class_id']} ({entry['format']}, {entry['number_of_heats']} heats): " \
+                  f"{entry['rankings']} rankings ({entry['cached']} cached), " \
+                  f"avg {entry['total_ms']/entry['rankings']:.1f} ms, max {entry['max_ms']:.1f} ms, " \
+                  f"avg {entry['db_calls']/entry['rankings']:.1f} DB calls"
+        logger.info(message)
+        rhapi.ui.message_notify(message)
+
 def initialize(rhapi):
+    # diagnostics
+    rhapi.ui.register_panel('class_rank_brackets', "Brackets Ranking", 'format')
+    rhapi.ui.register_quickbutton('class_rank_brackets', 'brackets_ranking_stats', "Ranking statistics", lambda args: show_ranking_stats(rhapi, args))
+    # background recomputation
+    rhapi.fields.register_option(UIField('brackets_recompute_window',
+        "Recompute delay (ms)",
+        UIFieldType.BASIC_INT,
+        value=str(DEFAULT_RECOMPUTE_WINDOW),
+        desc="Bracket rankings are computed again in the background once no result has changed for this delay, 0 to compute them only on demand"),
+        'class_rank_brackets')
+    scheduler.rhapi = rhapi
+    snapshots.rhapi = rhapi
     # initialization
     rhapi.events.on(Evt.CLASS_RANK_INITIALIZE, lambda args: register_handlers(rhapi, args))
     # update
     rhapi.events.on(Evt.CLASS_ADD, lambda args: register_handlers(rhapi, args))
     rhapi.events.on(Evt.CLASS_DUPLICATE, lambda args: register_handlers(rhapi, args))
-    rhapi.events.on(Evt.CLASS_ALTER, lambda args: register_handlers(rhapi, args))
-    rhapi.events.on(Evt.CLASS_DELETE, lambda args: register_handlers(rhapi, args))
+    rhapi.events.on(Evt.CLASS_ALTER, lambda args: on_class_change(rhapi, args))
+    rhapi.events.on(Evt.CLASS_DELETE, lambda args: on_class_change(rhapi, args))
+    # cache invalidation, run synchronously (priority < 100) so that no stale ranking is served after a change
+    rhapi.events.on(Evt.LAPS_SAVE, lambda args: on_race_change(rhapi, args), priority=50)
+    rhapi.events.on(Evt.LAPS_RESAVE, lambda args: on_race_change(rhapi, args), priority=50)
+    rhapi.events.on(Evt.RACE_ALTER, lambda args: on_race_change(rhapi, args), priority=50)
+    rhapi.events.on(Evt.HEAT_ADD, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.HEAT_DUPLICATE, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.HEAT_GENERATE, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.HEAT_ALTER, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.HEAT_DELETE, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.PILOT_ALTER, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.ROUNDS_RESET, lambda args: on_data_reset(rhapi, args), priority=50)
+    rhapi.events.on(Evt.DATABASE_RESET, lambda args: on_database_change(rhapi, args), priority=50)
+    rhapi.events.on(Evt.DATABASE_RESTORE, lambda args: on_database_change(rhapi, args), priority=50)
+    rhapi.events.on(Evt.DATABASE_RECOVER, lambda args: on_database_change(rhapi, args), priority=50)
+    rhapi.events.on(Evt.CACHE_CLEAR, lambda args: on_data_reset(rhapi, args), priority=50)
+    # standings changed in the last seconds are not lost
+    rhapi.events.on(Evt.SHUTDOWN, lambda args: snapshots.flush(), priority=50)